@@ -0,0 +1,122 @@
+# Batch-level data augmentation, applied after collation (in the main process or on the training device)
+# instead of per sample with PIL in the DataLoader workers.
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from random import randint
+import numpy as np
+import torch
+from PIL import Image
+
+# Random rotations and flips with the same distribution as DenoisingDataset's per-sample augmentation:
+# a decision in [0,99] rotates by 90/180/270 degrees when decision%10 is 0/1/2, and flips vertically/
+# horizontally/both when decision//10 is 0/1/2. Each clean/noisy pair gets the same transform.
+def random_dihedral(xbatch, ybatch):
+    decisions = torch.randint(0, 100, (xbatch.shape[0],))
+    rotations = decisions % 10
+    flips = decisions // 10
+    batch = torch.cat([xbatch, ybatch], 1)
+    for k in (1, 2, 3):
+        # torch.rot90 rotates counterclockwise from H to W, as PIL's rotate
+        indices = (rotations == k-1).nonzero().flatten()
+        if len(indices) > 0:
+            indices = indices.to(batch.device)
+            batch[indices] = torch.rot90(batch[indices], k, [2, 3])
+    for flip_dim, flip_decisions in ((2, (0, 2)), (3, (1, 2))):
+        indices = ((flips == flip_decisions[0]) | (flips == flip_decisions[1])).nonzero().flatten()
+        if len(indices) > 0:
+            indices = indices.to(batch.device)
+            batch[indices] = batch[indices].flip(flip_dim)
+    return batch[:, :xbatch.shape[1]], batch[:, xbatch.shape[1]:]
+
+# JPEG-compress and decompress an H x W x C uint8 array (libjpeg releases the GIL, this runs in threads)
+def jpeg_roundtrip(img, quality):
+    imbuffer = BytesIO()
+    Image.fromarray(img).save(imbuffer, 'JPEG', quality=quality)
+    imbuffer.seek(0)
+    return np.asarray(Image.open(imbuffer).convert('RGB'))
+
+# Augments collated (clean, noisy) batches: JPEG compression of the noisy batch in a thread pool (with an
+# optional LRU cache of compressed crops keyed by noisy crop and quality bucket), transfer to the training
+# device, random rotations/flips, and artificial gaussian noise generated on the device.
+# Compression levels are drawn in [compressionmin, compressionmax] and rounded to quality_bucket steps.
+# uint8 batches are transferred as-is (asynchronously if they are pinned), rotated, and converted to
+# float on the device; transferred bytes are counted to measure what this saves over float32 batches.
+class BatchAugmenter:
+    def __init__(self, device, dihedral=True, compressionmin=100, compressionmax=100, sigmamin=0, sigmamax=0,
+                 threads=4, compression_cache_bytes=0, quality_bucket=1):
+        self.device = device
+        self.dihedral = dihedral
+        self.compressionmin, self.compressionmax = compressionmin, compressionmax
+        self.sigmamin, self.sigmamax = sigmamin, sigmamax
+        self.quality_bucket = quality_bucket
+        self.compression_cache = OrderedDict()
+        self.compression_cache_bytes = compression_cache_bytes
+        self.compression_cache_used = 0
+        if compressionmin < 100:
+            self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.transferred_bytes = 0
+        self.float32_bytes = 0
+
+    def get_quality(self):
+        quality = randint(self.compressionmin, self.compressionmax)
+        return min(self.compressionmax, quality - (quality-self.compressionmin) % self.quality_bucket)
+
+    def compress(self, ybatch, ykeys=None):
+        float_input = ybatch.is_floating_point()
+        if float_input:
+            ybatch = ybatch.mul(255).round_().clamp_(0, 255).to(torch.uint8)
+        imgs = ybatch.permute(0, 2, 3, 1).contiguous().numpy()
+        qualities = [self.get_quality() for i in range(len(imgs))]
+        results = [None]*len(imgs)
+        jobs = []
+        for i, quality in enumerate(qualities):
+            if ykeys is not None and self.compression_cache_bytes > 0:
+                cache_key = (int(ykeys[i]), quality)
+                results[i] = self.compression_cache.get(cache_key)
+                if results[i] is not None:
+                    self.compression_cache.move_to_end(cache_key)
+                    continue
+            jobs.append((i, self.pool.submit(jpeg_roundtrip, imgs[i], quality)))
+        for i, job in jobs:
+            results[i] = job.result()
+            if ykeys is not None and self.compression_cache_bytes > 0:
+                self.compression_cache[(int(ykeys[i]), qualities[i])] = results[i]
+                self.compression_cache_used += results[i].nbytes
+                while self.compression_cache_used > self.compression_cache_bytes:
+                    _, evicted = self.compression_cache.popitem(last=False)
+                    self.compression_cache_used -= evicted.nbytes
+        ybatch = torch.from_numpy(np.stack(results)).permute(0, 3, 1, 2)
+        if float_input:
+            return ybatch.float().div_(255)
+        return ybatch
+
+    def add_noise(self, ybatch):
+        sigmas = torch.empty((ybatch.shape[0], 1, 1, 1), device=ybatch.device).uniform_(self.sigmamin, self.sigmamax)
+        return ybatch.add(torch.randn_like(ybatch).mul_(sigmas.div_(255))).abs_()
+
+    def __call__(self, xbatch, ybatch, ykeys=None):
+        if self.compressionmin < 100:
+            ybatch = self.compress(ybatch, ykeys)
+        # xbatch holds one clean crop per group of ybatch.shape[0]//xbatch.shape[0] noisy crops (iso_group_size)
+        group_size = ybatch.shape[0]//xbatch.shape[0]
+        self.transferred_bytes += xbatch.numel()*xbatch.element_size()+ybatch.numel()*ybatch.element_size()
+        self.float32_bytes += (xbatch.numel()*group_size+ybatch.numel())*4
+        xbatch = xbatch.to(self.device, non_blocking=xbatch.is_pinned())
+        ybatch = ybatch.to(self.device, non_blocking=ybatch.is_pinned())
+        if group_size > 1:
+            xbatch = xbatch.repeat_interleave(group_size, 0)
+        if self.dihedral:
+            xbatch, ybatch = random_dihedral(xbatch, ybatch)
+        if not xbatch.is_floating_point():
+            xbatch, ybatch = xbatch.float().div_(255), ybatch.float().div_(255)
+        if self.sigmamax > 0:
+            ybatch = self.add_noise(ybatch)
+        return xbatch, ybatch
+
+    def get_transfer_stats(self, reset=False):
+        res = 'Worker IPC and host to device transfers: %u MB (%u MB saved over float32)' % (
+            self.transferred_bytes // 1048576, (self.float32_bytes-self.transferred_bytes) // 1048576)
+        if reset:
+            self.transferred_bytes = self.float32_bytes = 0
+        return res
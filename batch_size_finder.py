@@ -0,0 +1,178 @@
+# Finds the largest batch size whose training (or inference) step fits in a memory budget, for batch_size 'auto'.
+# The step is probed at doubling batch sizes then bisected between the largest one which fits and the
+# smallest one which does not. On CUDA the peak memory reserved by the allocator is measured and the budget
+# is a share of the device's memory; on CPU the peak RSS is measured (Linux, reset through
+# /proc/self/clear_refs) and the budget is the current RSS plus a share of the available memory. Sizes whose
+# memory use, extrapolated from the previous probe, would exceed the budget are not run (no OOM on CPU).
+# Results are cached in a JSON file per (step description, device).
+import json
+import os
+import resource
+import torch
+from checkpoint_writer import snapshot
+
+default_cache_path = os.path.join('models', 'batch_sizes.json')
+
+# argparse type for batch sizes which may be 'auto'
+def batch_size_type(value):
+    return value if value == 'auto' else int(value)
+
+def read_proc_kib(path, field):
+    with open(path, 'r') as f:
+        for line in f:
+            if line.startswith(field+':'):
+                return int(line.split()[1])*1024
+    return None
+
+def get_device_name(device):
+    device = torch.device(device)
+    if device.type == 'cuda':
+        properties = torch.cuda.get_device_properties(device)
+        return '%s (%u MiB)' % (properties.name, properties.total_memory//1048576)
+    try:
+        return 'cpu (%u MiB)' % (read_proc_kib('/proc/meminfo', 'MemTotal')//1048576)
+    except (OSError, TypeError):
+        return 'cpu'
+
+def get_memory_used(device):
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.memory_reserved(device)
+    try:
+        return read_proc_kib('/proc/self/status', 'VmRSS')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+def get_memory_budget(device, memory_fraction):
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.get_device_properties(device).total_memory*memory_fraction
+    try:
+        return get_memory_used(device)+read_proc_kib('/proc/meminfo', 'MemAvailable')*memory_fraction
+    except (OSError, TypeError):
+        return None
+
+def reset_peak_memory(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+        return
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def get_peak_memory(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_reserved(device)
+    try:
+        return read_proc_kib('/proc/self/status', 'VmHWM')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+def is_out_of_memory(error):
+    return isinstance(error, MemoryError) or 'out of memory' in str(error)
+
+# peak memory used by probe(batch_size), None if it ran out of memory
+def measure_peak_memory(probe, batch_size, device):
+    reset_peak_memory(device)
+    try:
+        probe(batch_size)
+    except (RuntimeError, MemoryError) as e:
+        if not is_out_of_memory(e):
+            raise
+        return None
+    finally:
+        if torch.device(device).type == 'cuda':
+            torch.cuda.empty_cache()
+    return get_peak_memory(device)
+
+# largest batch size (up to max_batch_size) for which probe(batch_size) fits in the budget. extra_bytes are
+# added to every measurement (eg optimizer state which is not allocated by the probe).
+def find_batch_size(probe, device, description, cache_path=default_cache_path, memory_fraction=0.9,
+                    max_batch_size=1024, extra_bytes=0, printer=None):
+    pfun = print if printer is None else printer.print
+    key = '%s on %s (memory_fraction=%s)' % (description, get_device_name(device), memory_fraction)
+    cache = {}
+    if os.path.isfile(cache_path):
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+    if key in cache and cache[key] <= max_batch_size:
+        pfun('Batch size: %u (cached for %s)' % (cache[key], key))
+        return cache[key]
+    budget = get_memory_budget(device, memory_fraction)
+    baseline = get_memory_used(device)
+    fits, fails = 0, max_batch_size+1
+    batch_size = 1
+    last_fit = None
+    while fails-fits > 1:
+        predicted = None
+        if last_fit is not None:
+            last_size, last_peak = last_fit
+            predicted = baseline+(last_peak-baseline)*batch_size/last_size+extra_bytes
+        if budget is not None and predicted is not None and predicted > budget:
+            peak = None
+        else:
+            peak = measure_peak_memory(probe, batch_size, device)
+            if peak is not None:
+                peak += extra_bytes
+        if peak is not None and (budget is None or peak <= budget):
+            pfun('Batch size %u: fits (%u MiB)' % (batch_size, peak//1048576))
+            fits, last_fit = batch_size, (batch_size, peak)
+        else:
+            pfun('Batch size %u: does not fit' % batch_size)
+            fails = batch_size
+        batch_size = min(batch_size*2, max_batch_size) if fails > max_batch_size else (fits+fails)//2
+    if fits == 0:
+        raise RuntimeError('%s does not fit in memory with a batch size of 1' % description)
+    cache[key] = fits
+    os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+    tmp_path = '%s.%u.tmp' % (cache_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, cache_path)
+    pfun('Batch size: %u (cached in %s)' % (fits, cache_path))
+    return fits
+
+# one training step of the generator and the discriminators on random crops, through their learn methods (with
+# their losses, precision and gradient scaling) without stepping the optimizers. The models' weights, buffers (eg
+# batch normalization statistics) and attributes (eg losses) are restored and their gradients cleared afterwards.
+# discriminator(2) is None if it is not used or not on this device (its loss is then replaced by a constant).
+def probe_training_step(generator, discriminator, discriminator2, crop_size, crop_boundaries, device):
+    models = [model for model in (generator, discriminator, discriminator2) if model is not None]
+    states = [snapshot(model.get_module().state_dict()) for model in models]
+    attributes = [dict(model.__dict__) for model in models]
+    def probe(batch_size):
+        try:
+            clean_batch = torch.rand(batch_size, 3, crop_size, crop_size, device=device)
+            noisy_batch = torch.rand(batch_size, 3, crop_size, crop_size, device=device)
+            generated_batch = generator.denoise_batch(noisy_batch)
+            lb, up = crop_boundaries
+            clean_batch_cropped = clean_batch[:, :, lb:up, lb:up]
+            noisy_batch_cropped = noisy_batch[:, :, lb:up, lb:up]
+            generated_batch_cropped = generated_batch[:, :, lb:up, lb:up]
+            predictions = {}
+            losses = {}
+            for key, weight_key, model in (('D', 'D1', discriminator), ('D2', 'D2', discriminator2)):
+                if model is not None:
+                    model.learn(generated_batch_cropped=generated_batch_cropped, clean_batch_cropped=clean_batch_cropped,
+                                noisy_batch_cropped=noisy_batch_cropped, step=False)
+                    predictions[key] = model.discriminate_batch(generated_batch_cropped=generated_batch_cropped,
+                                                                noisy_batch_cropped=noisy_batch_cropped)
+                elif generator.weights[weight_key] > 0:
+                    losses[key] = torch.zeros((), device=device)
+            generator.learn(generated_batch_cropped=generated_batch_cropped, clean_batch_cropped=clean_batch_cropped,
+                            discriminator_predictions=predictions.get('D'), discriminator2_predictions=predictions.get('D2'),
+                            discriminator_loss=losses.get('D'), discriminator2_loss=losses.get('D2'), step=False)
+        finally:
+            for model, state, model_attributes in zip(models, states, attributes):
+                model.optimizer.zero_grad(set_to_none=True)
+                model.get_module().load_state_dict(state)
+                model.__dict__.clear()
+                model.__dict__.update(model_attributes)
+    return probe
+
+# bytes of optimizer state (Adam's two moments) which training allocates on its first step
+def get_optimizer_state_bytes(models):
+    return sum(2*parameter.numel()*parameter.element_size() for model in models for parameter in model.get_module().parameters())
@@ -0,0 +1,52 @@
+# Writes checkpoints from a background thread so that saving does not stall training.
+# The state to save is snapshotted when save() is called (tensors are copied to host memory), it is then
+# serialized to a temporary file which atomically replaces the destination, so a checkpoint is either
+# the previous one or the complete new one even if training is interrupted while writing.
+import os
+import queue
+import threading
+import torch
+
+# copy of a (nested) state where every tensor is copied to host memory
+def snapshot(state):
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    elif isinstance(state, dict):
+        return type(state)((key, snapshot(value)) for key, value in state.items())
+    elif isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+class CheckpointWriter:
+    def __init__(self, printer=None):
+        self.print = print if printer is None else printer.print
+        self.checkpoints = queue.Queue()
+        self.writer_thread = threading.Thread(target=self.write, daemon=True)
+        self.writer_thread.start()
+
+    def write(self):
+        while True:
+            item = self.checkpoints.get()
+            if item is None:
+                self.checkpoints.task_done()
+                return
+            state, path = item
+            tmp_path = path+'.tmp'
+            try:
+                torch.save(state, tmp_path)
+                os.replace(tmp_path, path)
+            except Exception as e:
+                self.print('Warning: could not save checkpoint %s: %s' % (path, e))
+            self.checkpoints.task_done()
+
+    def save(self, state, path):
+        self.checkpoints.put((snapshot(state), path))
+
+    # wait until every queued checkpoint is written
+    def flush(self):
+        self.checkpoints.join()
+
+    def close(self):
+        if self.writer_thread.is_alive():
+            self.checkpoints.put(None)
+            self.writer_thread.join()
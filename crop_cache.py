@@ -0,0 +1,81 @@
+# RAM cache of decoded uint8 crops shared by all DataLoader workers. Storage is a fixed number of
+# cs x cs x 3 slots allocated in shared memory (/dev/shm) within a byte budget, each image is
+# identified by an integer key in [0, num_keys) and the least recently used slot is evicted when
+# the cache is full. Hit/miss counters are shared as well so the main process can report them.
+import multiprocessing
+import torch
+import numpy as np
+
+class SharedCropCache:
+    def __init__(self, num_keys, cs, budget_bytes):
+        slot_bytes = cs*cs*3
+        self.cs = cs
+        self.num_slots = int(max(0, min(num_keys, budget_bytes // slot_bytes)))
+        self.data = torch.empty((self.num_slots, cs, cs, 3), dtype=torch.uint8).share_memory_()
+        self.slot_dims = torch.zeros((self.num_slots, 2), dtype=torch.int32).share_memory_()
+        self.slot_key = torch.full((self.num_slots,), -1, dtype=torch.int64).share_memory_()
+        self.slot_last_use = torch.zeros((self.num_slots,), dtype=torch.int64).share_memory_()
+        self.key_slot = torch.full((num_keys,), -1, dtype=torch.int32).share_memory_()
+        # clock, hits, misses
+        self.counters = torch.zeros((3,), dtype=torch.int64).share_memory_()
+        self.lock = multiprocessing.Lock()
+        self.views = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['views'] = None
+        return state
+
+    # numpy views of the shared tensors (cheaper element access than tensor indexing)
+    def get_views(self):
+        if self.views is None:
+            self.views = [t.numpy() for t in (self.data, self.slot_dims, self.slot_key, self.slot_last_use,
+                                              self.key_slot, self.counters)]
+        return self.views
+
+    def get(self, key):
+        data, slot_dims, _, slot_last_use, key_slot, counters = self.get_views()
+        with self.lock:
+            slot = key_slot[key]
+            if slot < 0:
+                counters[2] += 1
+                return None
+            counters[0] += 1
+            counters[1] += 1
+            slot_last_use[slot] = counters[0]
+            height, width = slot_dims[slot]
+            return data[slot, :height, :width].copy()
+
+    def put(self, key, img):
+        height, width = img.shape[:2]
+        if self.num_slots == 0 or height > self.cs or width > self.cs:
+            return
+        data, slot_dims, slot_key, slot_last_use, key_slot, counters = self.get_views()
+        with self.lock:
+            if key_slot[key] >= 0:
+                return
+            # unused slots have a last use of 0 and are filled first
+            slot = np.argmin(slot_last_use)
+            if slot_key[slot] >= 0:
+                key_slot[slot_key[slot]] = -1
+            data[slot, :height, :width] = img
+            slot_dims[slot] = (height, width)
+            slot_key[slot] = key
+            key_slot[key] = slot
+            counters[0] += 1
+            slot_last_use[slot] = counters[0]
+
+    def get_hit_rate(self):
+        hits, misses = int(self.counters[1]), int(self.counters[2])
+        return hits/(hits+misses) if hits+misses > 0 else 0
+
+    def get_stats(self, reset=False):
+        hits, misses = int(self.counters[1]), int(self.counters[2])
+        used_slots = int((self.slot_key >= 0).sum())
+        res = 'Crop cache: %.1f%% hit rate (%u/%u lookups), %u/%u slots used (%u MB)' % (
+            100*self.get_hit_rate(), hits, hits+misses, used_slots, self.num_slots,
+            self.data.numel() // 1048576)
+        if reset:
+            with self.lock:
+                self.counters[1:] = 0
+        return res
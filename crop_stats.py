@@ -0,0 +1,58 @@
+# This script computes statistics of every crop in a pre-cropped dataset: mean, variance, and edge energy
+# (mean squared luminance gradient) of the base-ISO crop, and the estimated noise level (standard deviation
+# of noisy - clean) of every other ISO value. They are used by DenoisingDataset to filter or weight crops.
+# typical I/O:
+# input: datasets/train/NIND_<cs>_<ucs>/<set>/ISO<val>/NIND_<set>_ISO<val>_<xpos>_<ypos>_<ucs>.<ext>
+# output: datasets/train/NIND_<cs>_<ucs>.stats.npz
+
+import argparse
+from multiprocessing import Pool, cpu_count
+import os
+import numpy as np
+from PIL import Image
+from dataset_torch_3 import DenoisingDataset, get_crop_stats_path
+
+parser = argparse.ArgumentParser(description='Per-crop statistics of a pre-cropped dataset')
+parser.add_argument('--train_data', nargs='*', default=['datasets/train/NIND_128_112'], help='(space-separated) Path(s) to the pre-cropped training data (default: datasets/train/NIND_128_112)')
+parser.add_argument('--max_threads', type=int, help='Maximum number of processes, default=#threads')
+
+def load_float(path):
+    return np.asarray(Image.open(path).convert('RGB'), dtype=np.float32)/255
+
+def get_stats(index):
+    isos_start, isos_mid, isos_end = dataset.set_iso_offsets[dataset.crop_set[index]]
+    clean = load_float(dataset.get_crop_path(index, isos_start))
+    luminance = clean @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    edge_energy = np.square(np.diff(luminance, axis=0)).mean()+np.square(np.diff(luminance, axis=1)).mean()
+    noise = []
+    for iso_id in range(isos_mid, isos_end):
+        noisy = load_float(dataset.get_crop_path(index, iso_id))
+        noise.append(float((noisy-clean).std()) if noisy.shape == clean.shape else float('nan'))
+    return float(clean.mean()), float(clean.var()), float(edge_energy), noise
+
+def init_worker(ds):
+    global dataset
+    dataset = ds
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    for datadir in args.train_data:
+        ds = DenoisingDataset([datadir])
+        with Pool(args.max_threads if args.max_threads else cpu_count(), initializer=init_worker, initargs=(ds,)) as pool:
+            stats = pool.map(get_stats, range(len(ds)), chunksize=64)
+        noise_crop, noise_iso, noise_sigma = [], [], []
+        for index, (_, _, _, noise) in enumerate(stats):
+            isos_mid = ds.set_iso_offsets[ds.crop_set[index], 1]
+            for i, sigma in enumerate(noise):
+                noise_crop.append(index)
+                noise_iso.append(ds.iso_names[isos_mid+i])
+                noise_sigma.append(sigma)
+        np.savez(get_crop_stats_path(datadir),
+                 set_name=np.array([os.path.basename(set_dir) for set_dir in ds.set_dirs])[ds.crop_set],
+                 x=ds.crop_x, y=ds.crop_y,
+                 mean=np.array([s[0] for s in stats], dtype=np.float32),
+                 variance=np.array([s[1] for s in stats], dtype=np.float32),
+                 edge_energy=np.array([s[2] for s in stats], dtype=np.float32),
+                 noise_crop=np.array(noise_crop, dtype=np.int32), noise_iso=np.array(noise_iso),
+                 noise_sigma=np.array(noise_sigma, dtype=np.float32))
+        print('Saved statistics of %u crops to %s' % (len(ds), get_crop_stats_path(datadir)))
@@ -1,13 +1,19 @@
 # NIND dataset handler for pytorch. Loads the pre-cropped dataset, returns clean, noisy crops where noise value is randomized (unless specified in yval). Supports on-the-fly compression (compressionmin, compressionmax), artificial noise (sigmamin, sigmamax), and test_reserve (with exact_reserve or keyword search)
 
 import os
+import json
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
 from PIL import Image, ImageOps
 import torchvision
-from random import randint, uniform, choice
+from random import randint, uniform, sample
 from math import floor
 from io import BytesIO
 import torch
+import numpy as np
+from crop_cache import SharedCropCache
 
 # Sort ISO values (eg ISO200, ISO6400, ...), handles ISOH1, ISOH2, ..., ISOHn as last, handles ISO200-n, ISO6400-n, ... as usable duplicates
 def sortISOs(rawISOs):
@@ -57,8 +63,72 @@ def sortISOs(rawISOs):
     isos.extend(hisos)
     return bisos, isos
 
+# Reads an image's dimensions from its header (the image data is not decoded)
+def get_image_size(path):
+    with Image.open(path) as img:
+        return img.size
+
+# Per-crop statistics computed by crop_stats.py are stored next to the dataset directory
+def get_crop_stats_path(datadir):
+    return os.path.normpath(datadir)+'.stats.npz'
+
+# Cached directory listings (and crop dimensions when a size check is requested) of a pre-cropped
+# dataset directory, stored next to it as <DATADIR>.index.json. Each listing is invalidated when the
+# mtime of its directory changes, so a warm start only needs one stat per directory.
+class DatasetIndexCache:
+    def __init__(self, datadir):
+        self.datadir = datadir
+        self.path = os.path.normpath(datadir)+'.index.json'
+        self.modified = False
+        try:
+            with open(self.path, 'r') as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = dict()
+
+    def listdir(self, *subdirs):
+        relpath = '/'.join(subdirs)
+        path = os.path.join(self.datadir, *subdirs)
+        mtime = os.stat(path).st_mtime
+        entry = self.index.get(relpath)
+        if entry is None or entry['mtime'] != mtime:
+            entry = {'mtime': mtime, 'files': sorted(os.listdir(path))}
+            self.index[relpath] = entry
+            self.modified = True
+        return entry['files']
+
+    def sizes(self, *subdirs, threads=None):
+        # must be called after listdir(*subdirs)
+        entry = self.index['/'.join(subdirs)]
+        if 'sizes' not in entry:
+            paths = [os.path.join(self.datadir, *subdirs, fn) for fn in entry['files']]
+            with ThreadPool(threads if threads else 4*cpu_count()) as pool:
+                entry['sizes'] = pool.map(get_image_size, paths, chunksize=32)
+            self.modified = True
+        return entry['sizes']
+
+    def save(self):
+        if not self.modified:
+            return
+        tmp_path = self.path+'.tmp'+str(os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.index, f)
+            os.replace(tmp_path, self.path)
+            self.modified = False
+        except OSError as e:
+            print('Warning: could not write dataset index cache: %s'%e)
+
+# DataLoader collate_fn for iso_group_size > 1: each sample holds a group of (clean, noisy[, key]) crops,
+# the groups are flattened into a batch of batch_size*iso_group_size pairs. With batched_augmentation the
+# clean crop is shared by its group and left as a batch of batch_size crops (BatchAugmenter repeats it on the
+# device).
+def collate_iso_groups(samples):
+    batch = default_collate(samples)
+    return [item if item.dim() == 4 else item.view(-1, *item.shape[2:]) for item in batch]
+
 class DenoisingDataset(Dataset):
-    def __init__(self, datadirs, testreserve=[], yval=None, compressionmin=100, compressionmax=100, sigmamin=0, sigmamax=0, test_reserve=[], do_sizecheck=False, exact_reserve=False):
+    def __init__(self, datadirs, testreserve=[], yval=None, compressionmin=100, compressionmax=100, sigmamin=0, sigmamax=0, test_reserve=[], do_sizecheck=False, exact_reserve=False, sizecheck_threads=None, cache_bytes=0, batched_augmentation=False, return_uint8=False, iso_group_size=1, crop_stats=False, min_crop_variance=0, min_crop_edge_energy=0):
         def keep_only_isoval_from_list(isos,keepval):
             keptisos = []
             for iso in isos:
@@ -76,17 +146,32 @@ class DenoisingDataset(Dataset):
             return False
         super(DenoisingDataset, self).__init__()
         self.totensor = torchvision.transforms.ToTensor()
-        # each dataset element is ["<DATADIR>/<SETNAME>/ISOBASE/<DSNAME>_<SETNAME>_ISOBASE_<XNUM>_<YNUM>_<UCS>.EXT", [<ISOVAL1>,...,<ISOVALN>]]
-        self.dataset = []
+        # the index is kept in flat numpy arrays rather than python objects so that DataLoader workers
+        # do not trigger a copy-on-write of the whole index by touching reference counts.
+        # per set: directory, crop filename prefix (<DSNAME>_<SETNAME>_), extension, and
+        # [start, mid) / [mid, end) offsets of its base ISOs / noisy ISOs in iso_names
+        # per crop: set id, XNUM, YNUM, UCS (crops are <SETDIR>/<ISO>/<PREFIX><ISO>_<XNUM>_<YNUM>_<UCS>.<EXT>)
+        set_dirs, set_prefixes, set_exts, set_iso_offsets, iso_names, set_datadir = [], [], [], [], [], []
+        crop_set, crop_x, crop_y, crop_ucs = [], [], [], []
         self.cs, self.ucs = [int(i) for i in datadirs[0].split('_')[-2:]]
         self.compressionmin, self.compressionmax = compressionmin, compressionmax
         self.sigmamin, self.sigmamax = sigmamin, sigmamax
-        for datadir in datadirs:
-            for aset in os.listdir(datadir):
+        # rotations, flips, compression, and artificial noise are left to augmentation.BatchAugmenter
+        # after collation, samples are returned with the key of their noisy crop
+        self.batched_augmentation = batched_augmentation
+        # uint8 tensors are 4x smaller to send from workers and to the device, BatchAugmenter converts them
+        self.return_uint8 = return_uint8
+        assert batched_augmentation or not return_uint8
+        # each sample holds iso_group_size noisy crops paired with the same clean crop (decoded once),
+        # use collate_iso_groups to flatten the groups into a batch of pairs
+        self.iso_group_size = iso_group_size
+        for datadir_id, datadir in enumerate(datadirs):
+            index_cache = DatasetIndexCache(datadir)
+            for aset in index_cache.listdir():
                 if is_reserved(aset):
                     print('Skipped '+aset+' (test reserve)')
                     continue
-                bisos, isos = sortISOs(os.listdir(os.path.join(datadir,aset)))
+                bisos, isos = sortISOs(index_cache.listdir(aset))
                 if yval is not None:
                     if yval == 'x':
                         bisos = isos = bisos[0:1]
@@ -95,59 +180,172 @@ class DenoisingDataset(Dataset):
                         if len(isos) == 0:
                             print('Skipped '+aset+' ('+yval+' not found)')
                             continue
-                # check for min size
-                for animg in os.listdir(os.path.join(datadir, aset, isos[0])):
+                crops = index_cache.listdir(aset, isos[0])
+                if do_sizecheck:
+                    crops_dims = index_cache.sizes(aset, isos[0], threads=sizecheck_threads)
+                set_id = len(set_dirs)
+                set_prefix = set_ext = None
+                for i, animg in enumerate(crops):
                     if not do_sizecheck:
                         imgdims = [int(animg.split('_')[-1].split('.')[0])]
                     else:
-                        imgdims = Image.open(os.path.join(datadir, aset, isos[0], animg)).size
+                        imgdims = crops_dims[i]
                     # check for min size
-                    #img4tests=Image.open(os.path.join(datadir, aset, isos[0], animg))
                     if all(d >= self.ucs for d in imgdims):
-                        self.dataset.append([os.path.join(datadir,aset,'ISOBASE',animg).replace(isos[0]+'_','ISOBASE_'), bisos,isos])
+                        name, _, ext = animg.rpartition('.')
+                        head, xnum, ynum, ucs = name.rsplit('_', 3)
+                        if set_prefix is None:
+                            set_prefix, set_ext = head[:-len(isos[0])], ext
+                        if head != set_prefix+isos[0] or ext != set_ext:
+                            print('Warning: skipped crop with unexpected filename: '+animg)
+                            continue
+                        crop_set.append(set_id)
+                        crop_x.append(int(xnum))
+                        crop_y.append(int(ynum))
+                        crop_ucs.append(int(ucs))
                     else:   # dbg check for quick check, if nothing prints then the above test can safely be removed
                         if int(animg.split('_')[-1].split('.')[0]) >= self.ucs:
                             print('Warning: UCS FN does not match: '+animg.split('_')[-1].split('.')[0])
                     # verify that no base-ISO image exceeds CS just because
                     if any(d > self.cs for d in imgdims):
                         print("Warning: excessive crop size for "+aset)
+                if set_prefix is None:
+                    continue
+                set_dirs.append(os.path.join(datadir, aset))
+                set_datadir.append(datadir_id)
+                set_prefixes.append(set_prefix)
+                set_exts.append(set_ext)
+                set_iso_offsets.append([len(iso_names), len(iso_names)+len(bisos), len(iso_names)+len(bisos)+len(isos)])
+                iso_names += bisos+isos
                 print('Added '+aset+str(bisos)+str(isos)+' to the dataset')
+            index_cache.save()
+        self.set_dirs = np.array(set_dirs)
+        self.set_prefixes = np.array(set_prefixes)
+        self.set_exts = np.array(set_exts)
+        self.set_iso_offsets = np.array(set_iso_offsets, dtype=np.int32).reshape(-1, 3)
+        self.iso_names = np.array(iso_names)
+        self.crop_set = np.array(crop_set, dtype=np.int32)
+        self.crop_x = np.array(crop_x, dtype=np.int32)
+        self.crop_y = np.array(crop_y, dtype=np.int32)
+        self.crop_ucs = np.array(crop_ucs, dtype=np.int32)
+        # crops statistics (mean, variance, edge_energy, noise) are NaN for crops missing from the stats file
+        self.crop_stats = None
+        if crop_stats or min_crop_variance > 0 or min_crop_edge_energy > 0:
+            self.load_crop_stats(datadirs, np.array(set_datadir, dtype=np.int32))
+            # crops without statistics are kept
+            keep = ~((self.crop_stats['variance'] < min_crop_variance)
+                     | (self.crop_stats['edge_energy'] < min_crop_edge_energy))
+            print('Kept %u/%u crops with variance >= %f and edge energy >= %f' % (
+                keep.sum(), len(keep), min_crop_variance, min_crop_edge_energy))
+            self.crop_set, self.crop_x, self.crop_y, self.crop_ucs = (
+                self.crop_set[keep], self.crop_x[keep], self.crop_y[keep], self.crop_ucs[keep])
+            self.crop_stats = {name: stat[keep] for name, stat in self.crop_stats.items()}
+        # decoded crops cache key: crop_key_start[crop] + position of the ISO value within its set
+        isos_per_crop = (self.set_iso_offsets[:, 2]-self.set_iso_offsets[:, 0])[self.crop_set].astype(np.int64)
+        self.crop_key_start = np.cumsum(isos_per_crop)-isos_per_crop
+        if cache_bytes > 0:
+            self.crop_cache = SharedCropCache(int(isos_per_crop.sum()), self.cs, cache_bytes)
+        else:
+            self.crop_cache = None
+
+    def load_crop_stats(self, datadirs, set_datadir):
+        self.crop_stats = {name: np.full(len(self.crop_set), np.nan, dtype=np.float32)
+                           for name in ('mean', 'variance', 'edge_energy', 'noise')}
+        for datadir_id, datadir in enumerate(datadirs):
+            stats_path = get_crop_stats_path(datadir)
+            if not os.path.isfile(stats_path):
+                print('Warning: %s not found, run crop_stats.py to generate it' % stats_path)
+                continue
+            with np.load(stats_path) as stats_file:
+                stats = {name: stats_file[name] for name in stats_file.files}
+            rows = {(str(set_name), int(x), int(y)): row for row, (set_name, x, y) in enumerate(
+                zip(stats['set_name'], stats['x'], stats['y']))}
+            # average noise level over all ISO values of a crop
+            noise_count = np.bincount(stats['noise_crop'], minlength=len(rows))
+            noise = np.bincount(stats['noise_crop'], weights=stats['noise_sigma'], minlength=len(rows))
+            stats['noise'] = noise/np.maximum(noise_count, 1)
+            missing = 0
+            for index in np.nonzero(set_datadir[self.crop_set] == datadir_id)[0]:
+                row = rows.get((os.path.basename(str(self.set_dirs[self.crop_set[index]])),
+                                int(self.crop_x[index]), int(self.crop_y[index])))
+                if row is None:
+                    missing += 1
+                    continue
+                for name in self.crop_stats:
+                    self.crop_stats[name][index] = stats[name][row]
+            if missing > 0:
+                print('Warning: %u crops are missing from %s, run crop_stats.py to update it' % (missing, stats_path))
+
+    # sampling weights proportional to a crop statistic (to the given power), for WeightedRandomSampler
+    def get_crop_weights(self, stat='edge_energy', power=1):
+        weights = np.power(self.crop_stats[stat].astype(np.float64), power)
+        weights[~np.isfinite(weights)] = np.nanmean(weights[np.isfinite(weights)]) if np.isfinite(weights).any() else 1
+        return weights/weights.sum()
+
+    # path of a crop given its index and the position of its ISO value in iso_names
+    def get_crop_path(self, index, iso_id):
+        set_id = self.crop_set[index]
+        iso = str(self.iso_names[iso_id])
+        return os.path.join(str(self.set_dirs[set_id]), iso, '%s%s_%u_%u_%u.%s' % (
+            self.set_prefixes[set_id], iso, self.crop_x[index], self.crop_y[index], self.crop_ucs[index],
+            self.set_exts[set_id]))
 
-    def get_and_pad(self, index):
-        img = self.dataset[index]
-        xchoice = choice(img[1])
-        xpath = os.path.join(img[0].replace('ISOBASE_',xchoice+'_').replace('/ISOBASE/','/'+xchoice+'/'))
-        ychoice = choice(img[2])
-        ypath = os.path.join(img[0].replace('ISOBASE_',ychoice+'_').replace('/ISOBASE/','/'+ychoice+'/'))
-        ximg = Image.open(xpath)
-        if ximg.getbands() != ('R', 'G', 'B'):
-            ximg=ximg.convert('RGB')
-        yimg = Image.open(ypath)
-        if yimg.getbands() != ('R', 'G', 'B'):
-            yimg=yimg.convert('RGB')
-        if ximg.size != yimg.size:
-            print('Warning: crops do not match: '+xpath+', '+ypath)
-            return self.get_and_pad(index)
-        if all(d == self.cs for d in ximg.size):
-            return (ximg, yimg)
-        xnum, ynum, ucs = [int(i) for i in img[0].rpartition('.')[0].split('_')[-3:]]
-        if xnum == 0:
+    # unique integer identifying a crop at a given ISO value, in [0, sum of ISO values over all crops)
+    def get_crop_key(self, index, iso_id):
+        return int(self.crop_key_start[index]+iso_id-self.set_iso_offsets[self.crop_set[index], 0])
+
+    # load a crop as an RGB PIL image, through the decoded crops cache if there is one
+    def load_crop(self, index, iso_id):
+        if self.crop_cache is None:
+            img = Image.open(self.get_crop_path(index, iso_id))
+            if img.getbands() != ('R', 'G', 'B'):
+                img = img.convert('RGB')
+            return img
+        key = self.get_crop_key(index, iso_id)
+        cached_img = self.crop_cache.get(key)
+        if cached_img is not None:
+            return Image.fromarray(cached_img)
+        img = Image.open(self.get_crop_path(index, iso_id))
+        if img.getbands() != ('R', 'G', 'B'):
+            img = img.convert('RGB')
+        self.crop_cache.put(key, np.asarray(img))
+        return img
+
+    # pad a crop located on the left/top/right/bottom of its image to cs x cs
+    def pad(self, index, img):
+        if all(d == self.cs for d in img.size):
+            return img
+        if self.crop_x[index] == 0:
             # pad left
-            ximg = ximg.crop((-self.cs+ximg.width, 0, ximg.width, ximg.height))
-            yimg = yimg.crop((-self.cs+yimg.width, 0, yimg.width, yimg.height))
-        if ynum == 0:
+            img = img.crop((-self.cs+img.width, 0, img.width, img.height))
+        if self.crop_y[index] == 0:
             # pad top
-            ximg = ximg.crop((0, -self.cs+ximg.height, ximg.width, ximg.height))
-            yimg = yimg.crop((0, -self.cs+yimg.height, yimg.width, yimg.height))
-        if ximg.width < self.cs or ximg.height < self.cs:
+            img = img.crop((0, -self.cs+img.height, img.width, img.height))
+        if img.width < self.cs or img.height < self.cs:
             # pad right and bottom
-            ximg = ximg.crop((0, 0, self.cs, self.cs))
-            yimg = yimg.crop((0, 0, self.cs, self.cs))
-        return (ximg, yimg)
+            img = img.crop((0, 0, self.cs, self.cs))
+        return img
 
-    def __getitem__(self, reqindex):
-        ximg, yimg = self.get_and_pad(reqindex)
-        # data augmentation
+    # returns a clean PIL image and a list of num_noisy noisy PIL images (distinct ISO values when
+    # there are enough of them) padded to cs x cs, and the keys of the noisy crops
+    def get_and_pad(self, index, num_noisy=1):
+        isos_start, isos_mid, isos_end = self.set_iso_offsets[self.crop_set[index]]
+        xiso = randint(isos_start, isos_mid-1)
+        if num_noisy <= isos_end-isos_mid:
+            yisos = sample(range(isos_mid, isos_end), num_noisy)
+        else:
+            yisos = [randint(isos_mid, isos_end-1) for i in range(num_noisy)]
+        ximg = self.load_crop(index, xiso)
+        yimgs = [self.load_crop(index, yiso) for yiso in yisos]
+        for yiso, yimg in zip(yisos, yimgs):
+            if ximg.size != yimg.size:
+                print('Warning: crops do not match: '+self.get_crop_path(index, xiso)+', '+self.get_crop_path(index, yiso))
+                return self.get_and_pad(index, num_noisy)
+        return (self.pad(index, ximg), [self.pad(index, yimg) for yimg in yimgs],
+                [self.get_crop_key(index, yiso) for yiso in yisos])
+
+    @staticmethod
+    def random_dihedral(ximg, yimg):
         random_decision = randint(0, 99)
         if random_decision % 10 == 0:
             ximg = ximg.rotate(90)
@@ -164,6 +362,20 @@ class DenoisingDataset(Dataset):
         if floor(random_decision/10) == 1 or floor(random_decision/10) == 2:
             ximg = ImageOps.mirror(ximg)
             yimg = ImageOps.mirror(yimg)
+        return ximg, yimg
+
+    # PIL is H x W x C, the tensor is C x H x W
+    @staticmethod
+    def touint8tensor(img):
+        return torch.from_numpy(np.array(img)).permute(2, 0, 1).contiguous()
+
+    def make_pair(self, ximg, yimg, ykey):
+        if self.return_uint8:
+            return self.touint8tensor(ximg), self.touint8tensor(yimg), ykey
+        if self.batched_augmentation:
+            return self.totensor(ximg), self.totensor(yimg), ykey
+        # data augmentation
+        ximg, yimg = self.random_dihedral(ximg, yimg)
         if self.compressionmin < 100:
             quality = randint(self.compressionmin, self.compressionmax)
             imbuffer = BytesIO()
@@ -176,5 +388,18 @@ class DenoisingDataset(Dataset):
             noise = torch.randn(yimg.shape).mul_(uniform(self.sigmamin, self.sigmamax)/255)
             yimg = torch.abs(yimg+noise)
         return ximg, yimg
+
+    def __getitem__(self, reqindex):
+        ximg, yimgs, ykeys = self.get_and_pad(reqindex, self.iso_group_size)
+        if self.iso_group_size == 1:
+            return self.make_pair(ximg, yimgs[0], ykeys[0])
+        if self.batched_augmentation:
+            # the clean tensor is only converted and transferred once
+            xtensor = self.touint8tensor(ximg) if self.return_uint8 else self.totensor(ximg)
+            ytensor = [self.touint8tensor(yimg) if self.return_uint8 else self.totensor(yimg) for yimg in yimgs]
+            return xtensor, torch.stack(ytensor), torch.tensor(ykeys)
+        pairs = [self.make_pair(ximg, yimg, ykey) for yimg, ykey in zip(yimgs, ykeys)]
+        return torch.stack([pair[0] for pair in pairs]), torch.stack([pair[1] for pair in pairs])
+
     def __len__(self):
-        return len(self.dataset)
+        return len(self.crop_set)
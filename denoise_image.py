@@ -9,6 +9,7 @@ from torch.utils.data import DataLoader
 from torch.utils.data import Dataset
 import time
 from nn_common import Model, default_values
+from batch_size_finder import batch_size_type, find_batch_size
 import torch.backends.cudnn as cudnn
 try:
 	import piexif   # TODO make it optional
@@ -29,7 +30,8 @@ parser.add_argument('--ucs', type=int, help='Useful tile size (should be <=.75*c
 parser.add_argument('-ol', '--overlap', default=6, type=int, help='Merge crops with this much overlap (Reduces grid artifacts, may reduce sharpness between crops, costs computation time)')
 parser.add_argument('-i', '--input', default='in.jpg', type=str, help='Input image file')
 parser.add_argument('-o', '--output', default='out.tif', type=str, help='Output file with extension')
-parser.add_argument('-b', '--batch_size', type=int, default=1)  # TODO >1 is broken
+parser.add_argument('-b', '--batch_size', type=batch_size_type, default=1, help="Number of crops denoised at once, 'auto' for the largest one which fits in --memory_fraction of the device's memory (probed once per network and crop size, cached in models/batch_sizes.json)")
+parser.add_argument('--memory_fraction', type=float, default=0.9, help="Share of the device's memory used with --batch_size auto (default: 0.9)")
 parser.add_argument('--debug', action='store_true', help='Debug (store all intermediate crops in ./dbg, display useful messages)')
 parser.add_argument('--cuda_device', default=0, type=int, help='Device number (default: 0, typically 0-3]])')
 parser.add_argument('--exif_method', default='piexif', type=str, help='How is exif data copied over? (piexif, exiftool, noexif)')
@@ -118,6 +120,13 @@ model.eval()  # evaluation mode
 if torch.cuda.is_available():
 	model = model.cuda()
 ds = OneImageDS(args.input, cs, ucs, args.overlap)
+if args.batch_size == 'auto':
+	def probe_denoise(batch_size):
+		with torch.no_grad():
+			model(torch.rand(batch_size, 3, cs, cs).cuda())
+	args.batch_size = find_batch_size(probe_denoise, torch.device('cuda', torch.cuda.current_device()),
+		'denoising %s(%s), %ux%u crops' % (args.network, args.model_parameters, cs, cs),
+		memory_fraction=args.memory_fraction, max_batch_size=len(ds))
 # multiple workers cannot access the same PIL object without crash
 DLoader = DataLoader(dataset=ds, num_workers=0, drop_last=False, batch_size=args.batch_size, shuffle=False)
 topil = torchvision.transforms.ToPILImage()
@@ -140,9 +149,10 @@ for n_count, ydat in enumerate(DLoader):
 		print(str(n_count)+'/'+str(int(len(ds)/args.batch_size)))
 		ybatch, usefuldims, usefulstarts = ydat
 		ybatch = ybatch.cuda()
-		xbatch = model(ybatch)
+		with torch.no_grad():
+			xbatch = model(ybatch)
 		torch.cuda.synchronize()
-		for i in range(args.batch_size):
+		for i in range(xbatch.shape[0]):
 			ud = usefuldims[i]
 			# pytorch represents images as [channels, height, width]
 			# TODO test leaving on GPU longer
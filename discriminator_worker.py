@@ -0,0 +1,182 @@
+# Runs a discriminator on its own device (or beside the generator) in a background thread, so that its updates
+# overlap with the generator's step. torch releases the GIL while its kernels run, so a discriminator on
+# another GPU or on spare CPU cores trains in parallel with the generator.
+# Batches are queued (detached, they share memory with the training loop's tensors) and moved to the
+# worker's device in its thread. The generator's adversarial loss is computed by the worker as well: the
+# generator requests it before the discriminator learns from the same batch and receives the loss with its
+# gradient wrt the generated batch, which is injected into the generator's graph.
+# The loss of each learn call is kept in its own result and returned in order by collect_losses (once the
+# queued work is done). Other losses and predictions ranges are those of the last completed learn call (they
+# may be a few batches old).
+import queue
+import threading
+import torch
+import torch.nn.functional as F
+from nn_common import Discriminator, gen_target_probabilities
+
+# loss computed elsewhere, whose gradient wrt generated_batch is known
+class InjectedLoss(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, generated_batch, loss, gradient):
+        ctx.save_for_backward(gradient)
+        ctx.dtype = generated_batch.dtype
+        return loss.clone()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        gradient, = ctx.saved_tensors
+        return (grad_output*gradient).to(ctx.dtype), None, None
+
+class DiscriminatorWorker:
+    def __init__(self, device='cuda:0', **discriminator_options):
+        self.device = device
+        # the worker syncs its losses after every learn call, this does not stall the training loop
+        discriminator_options['loss_sync_interval'] = 1
+        self.discriminator = Discriminator(device=device, **discriminator_options)
+        self.commands = queue.Queue()
+        self.generator_losses = queue.Queue()
+        # one result per learn call (filled by the worker with its loss tensor), until collect_losses
+        self.learn_results = []
+        self.error = None
+        self.worker_thread = threading.Thread(target=self.work, daemon=True)
+        self.worker_thread.start()
+
+    def work(self):
+        if torch.device(self.device).type == 'cuda':
+            torch.cuda.set_device(self.device)
+        while True:
+            command = self.commands.get()
+            if command is None:
+                self.commands.task_done()
+                return
+            try:
+                if command[0] == 'learn':
+                    _, generated_batch_cropped, clean_batch_cropped, noisy_batch_cropped, step, result = command
+                    self.discriminator.learn(generated_batch_cropped=self.to_device(generated_batch_cropped),
+                                             clean_batch_cropped=self.to_device(clean_batch_cropped),
+                                             noisy_batch_cropped=self.to_device(noisy_batch_cropped), step=step)
+                    result['loss'] = self.discriminator.loss_tensor
+                    # the generator's loss is computed before learning, the fake batch is never reused
+                    self.discriminator.release_fake_batch()
+                elif command[0] == 'set_accumulation_steps':
+                    self.discriminator.set_accumulation_steps(command[1])
+                elif command[0] == 'generator_loss':
+                    _, generated_batch_cropped, noisy_batch_cropped = command
+                    self.generator_losses.put(self.compute_generator_loss(generated_batch_cropped, noisy_batch_cropped))
+            except Exception as e:
+                self.error = e
+                if command[0] == 'generator_loss':
+                    self.generator_losses.put(e)
+            self.commands.task_done()
+
+    def to_device(self, batch):
+        if batch is None:
+            return None
+        return batch.to(self.device, non_blocking=True)
+
+    # (loss, gradient of the loss wrt generated_batch_cropped) of the generator's batch with the current weights
+    def compute_generator_loss(self, generated_batch_cropped, noisy_batch_cropped):
+        generated_batch_cropped = self.to_device(generated_batch_cropped).float().requires_grad_(True)
+        predictions = self.discriminator.discriminate_batch(generated_batch_cropped=generated_batch_cropped,
+                                                            noisy_batch_cropped=self.to_device(noisy_batch_cropped))
+        predictions = predictions.float()
+        loss = F.mse_loss(predictions, gen_target_probabilities(True, predictions.shape, device=self.device, noisy=False))
+        scaler = self.discriminator.scaler
+        gradient, = torch.autograd.grad(scaler.scale(loss), generated_batch_cropped)
+        return loss.detach(), gradient/scaler.get_scale()
+
+    def check_error(self):
+        if self.error is not None:
+            raise RuntimeError('discriminator worker failed') from self.error
+
+    # wait until every queued command is done
+    def wait(self):
+        self.commands.join()
+        self.check_error()
+
+    def learn(self, generated_batch_cropped, clean_batch_cropped, noisy_batch_cropped=None, step=True):
+        self.check_error()
+        result = {}
+        self.learn_results.append(result)
+        self.commands.put(('learn', generated_batch_cropped.detach(), clean_batch_cropped.detach(),
+                           None if noisy_batch_cropped is None else noisy_batch_cropped.detach(), step, result))
+
+    # (on device) losses of the learn calls queued since the last call, in order
+    def collect_losses(self):
+        self.wait()
+        losses = [result['loss'] for result in self.learn_results]
+        self.learn_results = []
+        return losses
+
+    # the generator's loss is requested before the discriminator learns from the same batch and received
+    # (on the generator's device, differentiable wrt generated_batch_cropped) when the generator learns
+    def request_generator_loss(self, generated_batch_cropped, noisy_batch_cropped=None):
+        self.check_error()
+        self.commands.put(('generator_loss', generated_batch_cropped.detach(),
+                           None if noisy_batch_cropped is None else noisy_batch_cropped.detach()))
+
+    def get_generator_loss(self, generated_batch_cropped):
+        result = self.generator_losses.get()
+        if isinstance(result, Exception):
+            raise RuntimeError('discriminator worker failed') from result
+        loss, gradient = result
+        return InjectedLoss.apply(generated_batch_cropped, loss.to(generated_batch_cropped.device),
+                                  gradient.to(generated_batch_cropped.device))
+
+    # queued, so that it applies to the following learn calls only
+    def set_accumulation_steps(self, steps):
+        self.check_error()
+        self.commands.put(('set_accumulation_steps', steps))
+
+    # the worker releases it after every learn call
+    def release_fake_batch(self):
+        pass
+
+    def get_loss(self, on_device=False):
+        self.check_error()
+        if on_device:
+            loss_tensor = self.discriminator.loss_tensor
+            if loss_tensor is None:
+                return torch.tensor(float(self.discriminator.loss), device=self.device)
+            return loss_tensor
+        return self.discriminator.loss
+
+    def sync_losses(self):
+        self.wait()
+
+    def get_predictions_range(self):
+        return self.discriminator.get_predictions_range()
+
+    # everything else runs on the discriminator once its queued work is done
+    def accepts_crop_size(self, size):
+        self.wait()
+        return self.discriminator.accepts_crop_size(size)
+
+    def checkpoint_segments(self, names):
+        self.wait()
+        return self.discriminator.checkpoint_segments(names)
+
+    def get_learning_rate(self):
+        self.wait()
+        return self.discriminator.get_learning_rate()
+
+    def update_learning_rate(self, avg_loss):
+        self.wait()
+        return self.discriminator.update_learning_rate(avg_loss)
+
+    def save_model(self, model_dir, epoch, name, writer=None):
+        self.wait()
+        self.discriminator.save_model(model_dir, epoch, name, writer=writer)
+
+    def get_training_state(self):
+        self.wait()
+        return self.discriminator.get_training_state()
+
+    def load_training_state(self, state):
+        self.wait()
+        self.discriminator.load_training_state(state)
+
+    def close(self):
+        if self.worker_thread.is_alive():
+            self.commands.put(None)
+            self.worker_thread.join()
@@ -0,0 +1,49 @@
+# Memory-mapped cache of (noisy, generated, clean) crop triplets, used to train discriminators from the
+# outputs of a frozen generator without running it again. Crops are stored as float16 (the generated crops are
+# not clamped or quantized, so the discriminator learns from the same fakes as in training) in a single
+# num_samples x 3 x channels x height x width .npy file, which is deleted by close().
+import os
+import numpy as np
+import torch
+
+class GeneratorOutputCache:
+    def __init__(self, path, num_samples, crop_shape):
+        self.path = path
+        self.data = np.lib.format.open_memmap(path, mode='w+', dtype=np.float16, shape=(num_samples, 3)+tuple(crop_shape))
+        self.num_samples = 0
+
+    def __len__(self):
+        return self.num_samples
+
+    def is_full(self):
+        return self.num_samples == self.data.shape[0]
+
+    # add (the first samples of) a batch of float crops, returns the number of samples added
+    def add(self, noisy_batch, generated_batch, clean_batch):
+        count = min(noisy_batch.shape[0], self.data.shape[0]-self.num_samples)
+        triplets = torch.stack([noisy_batch[:count], generated_batch[:count], clean_batch[:count]], 1)
+        triplets = triplets.detach().to(torch.float16).cpu().numpy()
+        self.data[self.num_samples:self.num_samples+count] = triplets
+        self.num_samples += count
+        return count
+
+    def flush(self):
+        self.data.flush()
+
+    def close(self):
+        if self.data is None:
+            return
+        self.data = None
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+    # shuffled (noisy, generated, clean) batches of float crops on device (each batch is read in storage order)
+    def batches(self, batch_size, device):
+        order = torch.randperm(self.num_samples)
+        for start in range(0, self.num_samples-batch_size+1, batch_size):
+            indices = np.sort(order[start:start+batch_size].numpy())
+            triplets = torch.from_numpy(self.data[indices])
+            if torch.device(device).type == 'cuda':
+                triplets = triplets.pin_memory()
+            triplets = triplets.to(device, non_blocking=True).float()
+            yield triplets[:, 0], triplets[:, 1], triplets[:, 2]
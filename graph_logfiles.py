@@ -14,6 +14,7 @@ import graph_utils
 # python graph_logfiles.py --experiment "Hul(b)128Net" --yaxis "Average 1-SSIM loss" --smoothing_factor 20 --uneven_graphs
 # python graph_logfiles.py --experiment "Label smoothing" --yaxis "Average MSE loss (discriminator)" --pre "Loss_D: " --post " (" --smoothing_factor 2500 --uneven_graphs
 # python graph_logfiles.py --experiment "cGAN training performance" --yaxis "Average SSIM loss during training" --pre "Average SSIM loss: " --smoothing_factor 1 --uneven_graphs --xaxis Epoch
+# python graph_logfiles.py --experiment <experiment> --yaxis "Average 1-SSIM loss" --metric loss_G_SSIM --record_type epoch --smoothing_factor 1 --xaxis Epoch
 default_smoothing_factor = 50
 
 # Params
@@ -26,6 +27,8 @@ parser.add_argument('--smoothing_factor', type=int, default=default_smoothing_fa
 parser.add_argument('--uneven_graphs', action='store_true', help='Allow some graphs to display more data points')
 parser.add_argument('--pre', type=str, default="What precedes the variable to graph")
 parser.add_argument('--post', type=str, default="What follows the variable to graph")
+parser.add_argument('--metric', type=str, help='Graph this key of the metrics records (<log path>.jsonl, eg loss_G_SSIM, loss_D) instead of parsing the text log')
+parser.add_argument('--record_type', type=str, default='step', help='Type of metrics records to graph with --metric (step or epoch)')
 args = parser.parse_args()
 
 if args.xaxis is None:
@@ -89,14 +92,19 @@ data = dict()
 markers = graph_utils.make_markers_dict(components=experiment_raw.keys())
 smallest_log = None
 
+def parse_log(logfile_path):
+    if args.metric is not None:
+        return graph_utils.parse_metrics_file(logfile_path+'.jsonl', args.metric, record_type=args.record_type, smoothing_factor = args.smoothing_factor)
+    return graph_utils.parse_log_file(logfile_path, smoothing_factor = args.smoothing_factor, pre=args.pre, post=args.post)
+
 for component, path in experiment_raw.items():
     # if path is list
     if isinstance(path, list):
         data[component] = []
         for logfile_path in path:
-            data[component]+=graph_utils.parse_log_file(logfile_path, smoothing_factor = args.smoothing_factor, pre=args.pre, post=args.post)
+            data[component]+=parse_log(logfile_path)
     else:
-        data[component] = graph_utils.parse_log_file(path, smoothing_factor = args.smoothing_factor, pre=args.pre, post=args.post)
+        data[component] = parse_log(path)
     if smallest_log is None or smallest_log > len(data[component]):
         smallest_log = len(data[component])
 for component in data:
@@ -1,3 +1,5 @@
+import json
+
 def gen_markers(components):
     markers = []
     i = 0
@@ -46,3 +48,22 @@ def parse_log_file(path, smoothing_factor = 1, pre=None, post=None):
     print("Added %u points from %s"%(len(data), path))
     return data
 
+
+# metrics records (JSON Lines) written by nn_common.MetricsLogger
+def parse_metrics_file(path, key, record_type='step', smoothing_factor = 1):
+    data = []
+    i = 0
+    t = 0
+    with open(path, 'r') as f:
+        for l in f:
+            record = json.loads(l)
+            if record.get('type') != record_type or record.get(key) is None:
+                continue
+            t += record[key]
+            i += 1
+            if i >= smoothing_factor:
+                data.append(t/smoothing_factor)
+                i = 0
+                t = 0
+    print("Added %u points from %s"%(len(data), path))
+    return data
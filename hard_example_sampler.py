@@ -0,0 +1,69 @@
+# Batch sampler which oversamples the crops that recently had a high generator loss.
+# Per-crop losses are kept in a tensor on the training device and updated without synchronization (as an
+# exponential moving average), they are only copied to the host once per epoch to draw its batches.
+# Crops are drawn with probability uniform_floor/N + (1-uniform_floor)*softmax(loss/mean_loss/temperature),
+# crops which have not been seen yet are given the highest recorded loss.
+# The DataLoader delivers batches in order, the training loop matches each batch with its indices by calling
+# pop_batch() once per batch, and record() with the per-sample losses when the generator learned from it.
+from collections import deque
+import torch
+from torch.utils.data import Sampler
+
+class HardExampleBatchSampler(Sampler):
+    def __init__(self, num_samples, batch_size, temperature=1.0, uniform_floor=0.2, momentum=0.5, device='cpu'):
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.temperature = temperature
+        self.uniform_floor = uniform_floor
+        self.momentum = momentum
+        self.losses = torch.full((num_samples,), float('nan'), device=device)
+        self.pending_batches = deque()
+        # batch indices are staged in one pinned buffer, reused once its previous copy to the device is done
+        self.indices_buffer = None
+        self.indices_copied = None
+        if self.losses.is_cuda:
+            self.indices_buffer = torch.empty(batch_size, dtype=torch.long).pin_memory()
+            self.indices_copied = torch.cuda.Event()
+
+    def __len__(self):
+        return self.num_samples // self.batch_size
+
+    def get_probabilities(self):
+        losses = self.losses.cpu()
+        seen = ~torch.isnan(losses)
+        probabilities = torch.full((self.num_samples,), 1/self.num_samples)
+        if seen.any():
+            losses[~seen] = losses[seen].max()
+            hardness = torch.softmax(losses/losses.mean().clamp(min=1e-8)/self.temperature, 0)
+            probabilities = self.uniform_floor*probabilities+(1-self.uniform_floor)*hardness
+        return probabilities
+
+    def __iter__(self):
+        self.pending_batches.clear()
+        indices = torch.multinomial(self.get_probabilities(), len(self)*self.batch_size, replacement=True)
+        for batch in indices.view(len(self), self.batch_size).tolist():
+            self.pending_batches.append(batch)
+            yield batch
+
+    def pop_batch(self):
+        return self.pending_batches.popleft()
+
+    # per_sample_losses may hold several losses per index (eg iso_group_size pairs per crop), they are averaged
+    def record(self, indices, per_sample_losses):
+        if self.indices_buffer is None:
+            indices = torch.tensor(indices)
+        else:
+            self.indices_copied.synchronize()
+            self.indices_buffer[:len(indices)] = torch.tensor(indices)
+            indices = self.indices_buffer[:len(indices)].to(self.losses.device, non_blocking=True)
+            self.indices_copied.record()
+        new_losses = per_sample_losses.detach().view(len(indices), -1).mean(1).to(self.losses.dtype)
+        old_losses = self.losses[indices]
+        self.losses[indices] = torch.where(torch.isnan(old_losses), new_losses,
+                                           self.momentum*old_losses+(1-self.momentum)*new_losses)
+
+    def get_stats(self):
+        seen = ~torch.isnan(self.losses)
+        return 'Hard example sampler: %u/%u crops seen, loss range: %s' % (
+            int(seen.sum()), self.num_samples,
+            '%.3f-%.3f' % (float(self.losses[seen].min()), float(self.losses[seen].max())) if seen.any() else 'NA')
@@ -13,6 +13,20 @@ def create_window(window_size, channel):
     window = Variable(_2D_window.expand(channel, 1, window_size, window_size).contiguous())
     return window
 
+# The gaussian window is separable: each statistic is computed with a horizontal then a vertical 1D
+# convolution (2*window_size instead of window_size^2 multiply-adds per pixel, same result with zero
+# padding), and the five statistics are stacked along channels and filtered by the same grouped convs.
+# (horizontal, vertical) windows are cached per (window_size, channels, dtype, device).
+separable_windows = {}
+
+def get_separable_window(window_size, channel, dtype, device):
+    key = (window_size, channel, dtype, device)
+    if key not in separable_windows:
+        _1D_window = gaussian(window_size, 1.5).to(device=device, dtype=dtype)
+        separable_windows[key] = (_1D_window.view(1, 1, 1, window_size).expand(channel, 1, 1, window_size).contiguous(),
+                                  _1D_window.view(1, 1, window_size, 1).expand(channel, 1, window_size, 1).contiguous())
+    return separable_windows[key]
+
 def _ssim(img1, img2, window, window_size, channel, size_average = True):
     mu1 = F.conv2d(img1, window, padding = window_size//2, groups = channel)
     mu2 = F.conv2d(img2, window, padding = window_size//2, groups = channel)
@@ -35,38 +49,52 @@ def _ssim(img1, img2, window, window_size, channel, size_average = True):
     else:
         return ssim_map.mean(1).mean(1).mean(1)
 
+def _ssim_separable(img1, img2, window_size, size_average = True):
+    channel = img1.shape[1]
+    window_h, window_v = get_separable_window(window_size, 5*channel, img1.dtype, img1.device)
+    stats = torch.cat([img1, img2, img1*img1, img2*img2, img1*img2], 1)
+    stats = F.conv2d(stats, window_h, padding = (0, window_size//2), groups = 5*channel)
+    stats = F.conv2d(stats, window_v, padding = (window_size//2, 0), groups = 5*channel)
+    mu1, mu2, img1_sq, img2_sq, img1_img2 = stats.chunk(5, 1)
+
+    mu1_sq = mu1.pow(2)
+    mu2_sq = mu2.pow(2)
+    mu1_mu2 = mu1*mu2
+
+    sigma1_sq = img1_sq - mu1_sq
+    sigma2_sq = img2_sq - mu2_sq
+    sigma12 = img1_img2 - mu1_mu2
+
+    C1 = 0.01**2
+    C2 = 0.03**2
+
+    ssim_map = ((2*mu1_mu2 + C1)*(2*sigma12 + C2))/((mu1_sq + mu2_sq + C1)*(sigma1_sq + sigma2_sq + C2))
+
+    if size_average:
+        return ssim_map.mean()
+    else:
+        return ssim_map.mean((1, 2, 3))
+
 class SSIM(torch.nn.Module):
     def __init__(self, window_size = 11, size_average = True):
         super(SSIM, self).__init__()
         self.window_size = window_size
         self.size_average = size_average
-        self.channel = 1
-        self.window = create_window(window_size, self.channel)
 
     def forward(self, img1, img2):
-        (_, channel, _, _) = img1.size()
-
-        if channel == self.channel and self.window.data.type() == img1.data.type():
-            window = self.window
-        else:
-            window = create_window(self.window_size, channel)
-            
-            if img1.is_cuda:
-                window = window.cuda(img1.get_device())
-            window = window.type_as(img1)
-            
-            self.window = window
-            self.channel = channel
+        return _ssim_separable(img1, img2, self.window_size, self.size_average)
 
+# SSIM and L1 loss of the same pair of batches in one call
+class SSIML1(torch.nn.Module):
+    def __init__(self, window_size = 11, size_average = True):
+        super(SSIML1, self).__init__()
+        self.window_size = window_size
+        self.size_average = size_average
 
-        return _ssim(img1, img2, window, self.window_size, channel, self.size_average)
+    def forward(self, img1, img2):
+        l1 = (img1-img2).abs()
+        l1 = l1.mean() if self.size_average else l1.mean((1, 2, 3))
+        return _ssim_separable(img1, img2, self.window_size, self.size_average), l1
 
 def ssim(img1, img2, window_size = 11, size_average = True):
-    (_, channel, _, _) = img1.size()
-    window = create_window(window_size, channel)
-    
-    if img1.is_cuda:
-        window = window.cuda(img1.get_device())
-    window = window.type_as(img1)
-    
-    return _ssim(img1, img2, window, window_size, channel, size_average)
+    return _ssim_separable(img1, img2, window_size, size_average)
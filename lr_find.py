@@ -0,0 +1,190 @@
+# learning rate range test: train from freshly initialized weights while the learning rate grows exponentially from
+# --start_lr to --end_lr over --iterations batches, record the (exponentially smoothed) loss and suggest initial
+# learning rates (--g_lr, --d_lr, --d2_lr for nn_train.py): one tenth of the rate at which the smoothed loss is
+# the lowest. The sweep stops early once the smoothed loss exceeds --divergence times its minimum.
+# The generator is swept with its SSIM/L1 loss, each discriminator against the outputs of the trained generator
+# given by --g_model_path (the outputs of an untrained one are too easy to tell apart from clean images).
+# Records are written to results/lr_find/<expname>.jsonl (plot them with graph_logfiles.py --record_type lr_find
+# --metric smoothed_loss), eg:
+# python3 lr_find.py --g_network UNet --weight_SSIM 1 --d_network Hulf112Disc --batch_size 30 --train_data datasets/train/NIND_128_96
+import argparse
+import os
+import sys
+import math
+import datetime
+import torch
+from torch.utils.data import DataLoader
+import torch.backends.cudnn as cudnn
+from dataset_torch_3 import DenoisingDataset
+from nn_common import default_values, Generator, Discriminator, Printer, MetricsLogger, get_crop_boundaries
+
+parser = argparse.ArgumentParser(description='Learning rate range test for mthesis-denoise networks')
+parser.add_argument('--batch_size', type=int, default=18, help='Training batch size')
+parser.add_argument('--iterations', type=int, default=300, help='Number of batches over which the learning rate is swept (per network, default: 300)')
+parser.add_argument('--start_lr', type=float, default=1e-7, help='Learning rate of the first batch (default: 1e-7)')
+parser.add_argument('--end_lr', type=float, default=1, help='Learning rate of the last batch (default: 1)')
+parser.add_argument('--smoothing', type=float, default=0.98, help='Exponential smoothing factor of the recorded loss (default: 0.98)')
+parser.add_argument('--divergence', type=float, default=4, help='Stop a sweep once the smoothed loss exceeds this many times its minimum (default: 4)')
+parser.add_argument('--g_network', type=str, default=default_values['g_network'], help='Generator network (default: %s)'%default_values['g_network'])
+parser.add_argument('--g_activation', type=str, default='PReLU', help='Final activation function for generator')
+parser.add_argument('--g_funit', type=int, default=32, help='Filter unit size for generator')
+parser.add_argument('--g_model_path', help='Trained generator model path (.pth for model, .pt for dictionary) whose outputs the discriminators are swept against, required to sweep discriminators (the generator is swept from fresh weights)')
+parser.add_argument('--d_network', type=str, help='Discriminator network to sweep (default: none)')
+parser.add_argument('--d2_network', type=str, help='Discriminator2 network to sweep (default: none)')
+parser.add_argument('--d_activation', type=str, default='PReLU', help='Final activation function for discriminator')
+parser.add_argument('--d2_activation', type=str, default='PReLU', help='Final activation function for discriminator2')
+parser.add_argument('--d_funit', type=int, default=32, help='Filter unit size for discriminator')
+parser.add_argument('--d2_funit', type=int, default=32, help='Filter unit size for discriminator2')
+parser.add_argument('--d_model_path', help='Discriminator pretrained model path (.pth for model, .pt for dictionary)')
+parser.add_argument('--d2_model_path', help='Discriminator2 pretrained model path (.pth for model, .pt for dictionary)')
+parser.add_argument('--not_conditional', action='store_true', help='Regular GAN instead of cGAN')
+parser.add_argument('--not_conditional_2', action='store_true', help='Regular GAN instead of cGAN (discriminator2)')
+parser.add_argument('--beta1', type=float, default=default_values['beta1'], help='beta1 for adam. default=%f'%default_values['beta1'])
+parser.add_argument('--weight_SSIM', type=float, default=1, help='Weight on SSIM term in the generator objective (default: 1)')
+parser.add_argument('--weight_L1', type=float, default=0, help='Weight on L1 term in the generator objective (default: 0)')
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'fp16', 'bf16'], help='Forward passes precision (default: fp32)')
+parser.add_argument('--test_reserve', nargs='*', help='Space separated list of image sets to be reserved for testing')
+parser.add_argument('--train_data', nargs='*', help="(space-separated) Path(s) to the pre-cropped training data (default: %s)"%(" ".join(default_values['train_data'])))
+parser.add_argument('--cuda_device', default=0, type=int, help='Device number (default: 0, typically 0-3, -1 for CPU)')
+parser.add_argument('--threads', type=int, default=6, help='Number of threads for data loader to use')
+args = parser.parse_args()
+
+if (args.d_network is not None or args.d2_network is not None) and args.g_model_path is None:
+    print('Error: sweeping discriminators requires a trained generator (--g_model_path)')
+    exit(1)
+
+if args.test_reserve is None or args.test_reserve == []:
+    test_reserve = default_values['test_reserve']
+else:
+    test_reserve = args.test_reserve
+if args.train_data is None or args.train_data == []:
+    train_data = default_values['train_data']
+else:
+    train_data = args.train_data
+if args.cuda_device >= 0 and torch.cuda.is_available():
+    torch.cuda.set_device(args.cuda_device)
+    device = torch.device("cuda:"+str(args.cuda_device))
+else:
+    device = torch.device('cpu')
+
+def crop_batch(batch, boundaries):
+    return batch[:, :, boundaries[0]:boundaries[1], boundaries[0]:boundaries[1]]
+
+cudnn.benchmark = True
+
+torch.manual_seed(123)
+torch.cuda.manual_seed(123)
+
+expname = (datetime.datetime.now().isoformat()[:-10]+'_'+'_'.join(sys.argv).replace('/','-'))[0:255]
+txt_path = os.path.join('results', 'lr_find', expname)
+os.makedirs(os.path.dirname(txt_path), exist_ok=True)
+p = Printer(file_path=txt_path)
+p.print(args)
+p.print("cmd: python3 "+" ".join(sys.argv))
+metrics = MetricsLogger(file_path=txt_path+'.jsonl', console=print)
+
+DDataset = DenoisingDataset(train_data, test_reserve=test_reserve)
+data_loader = DataLoader(dataset=DDataset, num_workers=args.threads, drop_last=True, batch_size=args.batch_size,
+                         shuffle=True, pin_memory=device.type == 'cuda')
+if len(data_loader) == 0:
+    p.print('Error: the training data holds less than one batch (%u crops)' % len(DDataset))
+    exit(1)
+crop_boundaries = get_crop_boundaries(DDataset.cs, DDataset.ucs, network=args.g_network,
+                                      discriminator=args.d_network if args.d_network is not None else args.d2_network)
+loss_cs = crop_boundaries[1]-crop_boundaries[0]
+
+# (clean, noisy) batches on device, as many as needed
+def endless_batches():
+    while True:
+        for clean_batch, noisy_batch in data_loader:
+            yield clean_batch.to(device, non_blocking=True), noisy_batch.to(device, non_blocking=True)
+batches = endless_batches()
+
+def make_generator(weights, model_path=None):
+    return Generator(network=args.g_network, model_path=model_path, device=device, weights=weights,
+                     activation=args.g_activation, funit=args.g_funit, beta1=args.beta1, lr=args.start_lr,
+                     printer=p, precision=args.precision)
+
+# learn() trains model on one batch and returns its loss. Returns the suggested learning rate (None if the
+# smoothed loss is the lowest at the first learning rate, ie the sweep should start lower).
+def sweep(name, model, learn):
+    best_loss = None
+    average_loss = 0
+    lrs, smoothed_losses = [], []
+    for iteration in range(args.iterations):
+        lr = args.start_lr*(args.end_lr/args.start_lr)**(iteration/max(args.iterations-1, 1))
+        for param_group in model.optimizer.param_groups:
+            param_group['lr'] = lr
+        loss = learn()
+        # exponential moving average with bias correction
+        average_loss = args.smoothing*average_loss+(1-args.smoothing)*loss
+        smoothed_loss = average_loss/(1-args.smoothing**(iteration+1))
+        metrics.log('lr_find', console_line='%s: lr %e, loss %f, smoothed loss %f' % (name, lr, loss, smoothed_loss),
+                    network=name, step=iteration+1, lr=lr, loss=loss, smoothed_loss=smoothed_loss)
+        lrs.append(lr)
+        smoothed_losses.append(smoothed_loss)
+        if math.isnan(loss) or (best_loss is not None and smoothed_loss > args.divergence*best_loss):
+            p.print('%s: loss diverged at lr %e' % (name, lr))
+            break
+        if best_loss is None or smoothed_loss < best_loss:
+            best_loss = smoothed_loss
+    metrics.flush()
+    best_index = smoothed_losses.index(min(smoothed_losses))
+    # steepest descent of the smoothed loss (per decade of learning rate) before its minimum
+    slopes = [(smoothed_losses[i+1]-smoothed_losses[i])/math.log10(lrs[i+1]/lrs[i]) for i in range(best_index)]
+    steepest_lr = lrs[slopes.index(min(slopes))] if len(slopes) > 0 else None
+    suggested_lr = lrs[best_index]/10 if best_index > 0 else None
+    p.print('%s: minimum smoothed loss %f at lr %e, steepest descent at lr %s, suggested initial lr: %s' % (
+        name, smoothed_losses[best_index], lrs[best_index],
+        '%e' % steepest_lr if steepest_lr is not None else 'NA',
+        '%e' % suggested_lr if suggested_lr is not None else 'NA'))
+    if suggested_lr is None:
+        p.print('Warning: %s: the smoothed loss is the lowest at the first lr, rerun with a lower --start_lr' % name)
+    return suggested_lr
+
+suggestions = {}
+
+# generator (SSIM and L1 losses)
+# without any SSIM or L1 weight the default weights are used (as in nn_train.py)
+weight_SSIM, weight_L1 = args.weight_SSIM, args.weight_L1
+if weight_SSIM+weight_L1 <= 0:
+    weight_SSIM, weight_L1 = default_values['weights']['SSIM'], default_values['weights']['L1']
+    p.print('No SSIM or L1 weight, using the default ones')
+total = weight_SSIM+weight_L1
+generator = make_generator({'SSIM': weight_SSIM/total, 'L1': weight_L1/total, 'D1': 0, 'D2': 0})
+def learn_generator():
+    clean_batch, noisy_batch = next(batches)
+    generated_batch = generator.denoise_batch(noisy_batch)
+    generator.learn(generated_batch_cropped=crop_batch(generated_batch, crop_boundaries),
+                    clean_batch_cropped=crop_batch(clean_batch, crop_boundaries))
+    return generator.get_loss()['weighted']
+suggestions['g_lr'] = sweep('generator', generator, learn_generator)
+generator = None
+
+# discriminators, against the outputs of the trained generator
+if args.d_network is not None or args.d2_network is not None:
+    fixed_generator = make_generator({'SSIM': 1, 'L1': 0, 'D1': 0, 'D2': 0}, model_path=args.g_model_path)
+for name, lr_option, network, model_path, activation, funit, not_conditional in (
+        ('discriminator', 'd_lr', args.d_network, args.d_model_path, args.d_activation, args.d_funit, args.not_conditional),
+        ('discriminator2', 'd2_lr', args.d2_network, args.d2_model_path, args.d2_activation, args.d2_funit, args.not_conditional_2)):
+    if network is None:
+        continue
+    discriminator = Discriminator(network=network, model_path=model_path, device=device, activation=activation,
+                                  funit=funit, beta1=args.beta1, lr=args.start_lr, not_conditional=not_conditional,
+                                  printer=p, precision=args.precision)
+    if not discriminator.accepts_crop_size(loss_cs):
+        p.print('Error: %s does not accept %ux%u crops' % (network, loss_cs, loss_cs))
+        exit(1)
+    def learn_discriminator():
+        clean_batch, noisy_batch = next(batches)
+        with torch.no_grad():
+            generated_batch = fixed_generator.denoise_batch(noisy_batch)
+        discriminator.learn(noisy_batch_cropped=crop_batch(noisy_batch, crop_boundaries),
+                            generated_batch_cropped=crop_batch(generated_batch, crop_boundaries),
+                            clean_batch_cropped=crop_batch(clean_batch, crop_boundaries))
+        return discriminator.get_loss()
+    suggestions[lr_option] = sweep(name, discriminator, learn_discriminator)
+    discriminator = None
+
+p.print('Suggested nn_train.py options: '+' '.join(['--%s %s' % (option, '%.1e' % lr if lr is not None else 'NA')
+                                                  for option, lr in suggestions.items()]))
@@ -1,13 +1,17 @@
 import torch
 import torch.nn as nn
 import torch.optim as optim
+from torch.utils.checkpoint import checkpoint
+import functools
 from lib import pytorch_ssim
 from torch.optim import lr_scheduler
-import math
 import torchvision
 #from networks.p2p_networks import define_D
 import os
 import time
+import json
+import threading
+from collections import OrderedDict
 from networks.Hul import Hulb128Net, Hul112Disc, Hulf112Disc
 from networks.ThirdPartyNets import PatchGAN, UNet
 from networks.UtNet import UtNet, UtdNet
@@ -33,7 +37,8 @@ default_values = {
 
 
 class Model:
-    def __init__(self, save_dict=True, device='cuda:0', printer=None, debug_options=[]):
+    def __init__(self, save_dict=True, device='cuda:0', printer=None, debug_options=[], precision='fp32',
+                 accumulation_steps=1, loss_sync_interval=1):
         if printer is None:
             self.print = print
         else:
@@ -42,32 +47,135 @@ class Model:
         self.save_dict = save_dict
         self.device = device
         self.debug_options=debug_options
+        self.init_precision(precision)
+        # gradients of accumulation_steps batches are accumulated (and averaged) per optimizer step
+        self.accumulation_steps = accumulation_steps
+        # losses are kept on the device and only copied to self.loss (synchronizing) every loss_sync_interval
+        # calls to learn, get_loss() (and the decisions based on it) may therefore be slightly stale
+        self.loss_sync_interval = loss_sync_interval
+        self.learn_count = 0
 
-    def save_model(self, model_dir, epoch, name):
+    # mixed precision (fp16 or bf16): forward passes run under autocast, losses are computed in fp32 and
+    # fp16 gradients are scaled to avoid underflows. CPUs only autocast to bf16, fp16 falls back to bf16
+    # on CPU and bf16 falls back to fp16 on GPUs which do not support it.
+    def init_precision(self, precision):
+        self.device_type = torch.device(self.device).type
+        self.autocast_dtype = {'fp32': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}[precision]
+        if self.device_type == 'cpu' and self.autocast_dtype == torch.float16:
+            self.print('fp16 autocast is not supported on CPU, using bf16')
+            self.autocast_dtype = torch.bfloat16
+        elif self.device_type == 'cuda' and self.autocast_dtype == torch.bfloat16 and not torch.cuda.is_bf16_supported():
+            self.print('bf16 is not supported on %s, using fp16' % self.device)
+            self.autocast_dtype = torch.float16
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.autocast_dtype == torch.float16)
+
+    def autocast(self):
+        return torch.autocast(self.device_type, dtype=self.autocast_dtype, enabled=self.autocast_dtype is not None)
+
+    # writer: optional CheckpointWriter (state dictionaries are then saved in the background)
+    def save_model(self, model_dir, epoch, name, writer=None):
         save_path = os.path.join(model_dir, '%s_%u.pt' % (name, epoch))
-        if self.save_dict:
-            torch.save(self.model.state_dict(), save_path)
+        if self.save_dict and writer is not None:
+            writer.save(self.get_module().state_dict(), save_path)
+        elif self.save_dict:
+            torch.save(self.get_module().state_dict(), save_path)
+        else:
+            torch.save(self.get_module(), save_path+'h')
+
+    # everything needed to resume training: weights, optimizer, learning rate scheduler, loss scaler, loss
+    def get_training_state(self):
+        return {'model': self.get_module().state_dict(), 'optimizer': self.optimizer.state_dict(),
+                'scheduler': self.scheduler.state_dict(), 'scaler': self.scaler.state_dict(), 'loss': self.loss}
+
+    def load_training_state(self, state):
+        self.get_module().load_state_dict(state['model'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.scheduler.load_state_dict(state['scheduler'])
+        self.scaler.load_state_dict(state['scaler'])
+        self.loss = state['loss']
+
+    # wrap the model for distributed data-parallel training (gradients are averaged over all processes
+    # during backward, the process group must be initialized)
+    def distribute(self):
+        if torch.device(self.device).type == 'cuda':
+            self.model = nn.parallel.DistributedDataParallel(self.model, device_ids=[self.device])
         else:
-            torch.save(self.model, save_path+'h')
+            self.model = nn.parallel.DistributedDataParallel(self.model)
+
+    # activation checkpointing: the given child modules (names of network attributes, 'all' for every child
+    # with parameters) recompute their forward pass during backward instead of keeping their activations.
+    # Their forward method is wrapped so state_dict keys are unchanged. Returns the checkpointed names.
+    # The recomputation does not update batch normalization statistics a second time.
+    def checkpoint_segments(self, names):
+        module = self.get_module()
+        if 'all' in names:
+            names = [name for name, child in module.named_children() if len(list(child.parameters())) > 0]
+        segments = [name for name in names if isinstance(getattr(module, name, None), nn.Module)]
+        for name in segments:
+            child = getattr(module, name)
+            batchnorms = [submodule for submodule in child.modules() if isinstance(submodule, nn.modules.batchnorm._BatchNorm)]
+            child.forward = functools.partial(checkpointed_forward, child.forward, batchnorms)
+        return segments
+
+    # number of batches accumulated in the current optimizer step (fewer than accumulation_steps in the last,
+    # shorter window of an epoch), the loss of each batch is divided by it
+    def set_accumulation_steps(self, steps):
+        self.accumulation_steps = steps
+
+    # with distributed training, whether the gradients of the next forward/backward pass are synchronized
+    # (as DistributedDataParallel.no_sync does, only the last accumulated batch of a step needs to be)
+    def set_gradient_sync(self, sync):
+        if isinstance(self.model, nn.parallel.DistributedDataParallel):
+            self.model.require_backward_grad_sync = sync
+
+    # underlying network (without its DistributedDataParallel wrapper)
+    def get_module(self):
+        if isinstance(self.model, nn.parallel.DistributedDataParallel):
+            return self.model.module
+        return self.model
+
+    # dry run on a blank batch of size x size crops, returns False if the model cannot process it or
+    # (generators) if it does not return crops of the same size
+    def accepts_crop_size(self, size, input_channels=3, same_size_output=False):
+        was_training = self.model.training
+        self.model.eval()
+        try:
+            with torch.no_grad():
+                output = self.model(torch.zeros(1, input_channels, size, size, device=self.device))
+            return not same_size_output or tuple(output.shape[2:]) == (size, size)
+        except RuntimeError:
+            return False
+        finally:
+            self.model.train(was_training)
 
     @staticmethod
     def complete_path(path, keyword=''):
+        # highest <name>_<epoch>.pt(h) containing keyword, other files (eg training states, temporary files) are skipped
         def find_highest(paths, keyword):
             best = [None, 0]
             for path in paths:
-                curval = int(path.split('_')[-1].split('.')[0])
-                if curval > best[1] and keyword in path:
+                if keyword not in path or not (path.endswith('.pt') or path.endswith('.pth')):
+                    continue
+                try:
+                    curval = int(path.split('_')[-1].split('.')[0])
+                except ValueError:
+                    continue
+                if curval > best[1]:
                     best = [path, curval]
             return best[0]
         if os.path.isfile(path):
             return path
         elif os.path.isdir(path):
-            return os.path.join(path, find_highest(os.listdir(path), keyword))
+            highest = find_highest(os.listdir(path), keyword)
+            if highest is None:
+                print("No model%s found in %s"%(' ('+keyword+')' if keyword != '' else '', path))
+                exit(1)
+            return os.path.join(path, highest)
         elif os.path.isdir(os.path.join('models', path)):
             return Model.complete_path(os.path.join('models', path), keyword)
         else:
             print("Model path not found: %s"%path)
-            exit(0)
+            exit(1)
 
     @staticmethod
     def instantiate_model(model_path=None, network=None, device='cuda:0', strparameters=None, pfun=print, keyword='', **parameters):
@@ -89,6 +197,9 @@ class Model:
             model = globals()[network](**parameters)
         return model.to(device)
 
+    def get_learning_rate(self):
+        return self.optimizer.param_groups[0]['lr']
+
     def update_learning_rate(self, avg_loss):
         self.scheduler.step(metrics=avg_loss)
         lr = self.optimizer.param_groups[0]['lr']
@@ -100,13 +211,22 @@ class Generator(Model):
     def __init__(self, network = default_values['g_network'], model_path = None,
                  device = 'cuda:0', weights=default_values['weights'], activation='PReLU', funit=32,
                  beta1=default_values['beta1'], lr=default_values['lr'], printer=None, compute_SSIM_anyway=False,
-                 save_dict=True, patience=default_values['patience'], debug_options=[]):
-        Model.__init__(self, save_dict, device, printer, debug_options=[])
+                 save_dict=True, patience=default_values['patience'], debug_options=[], track_per_sample_loss=False,
+                 precision='fp32', accumulation_steps=1, loss_sync_interval=1):
+        Model.__init__(self, save_dict, device, printer, debug_options=[], precision=precision,
+                       accumulation_steps=accumulation_steps, loss_sync_interval=loss_sync_interval)
         self.weights = weights
+        # keep the (detached) weighted SSIM+L1 loss of each sample of the last batch
+        self.track_per_sample_loss = track_per_sample_loss
+        self.per_sample_loss = None
         if weights['SSIM'] > 0 or compute_SSIM_anyway:
-            self.criterion_SSIM = pytorch_ssim.SSIM().to(device)
+            self.criterion_SSIM = pytorch_ssim.SSIM(size_average=not track_per_sample_loss).to(device)
         if weights['L1'] > 0:
             self.criterion_L1 = nn.L1Loss().to(device)
+        # SSIM and L1 computed together (per sample if they are tracked)
+        self.criterion_SSIM_L1 = None
+        if (weights['SSIM'] > 0 or compute_SSIM_anyway) and weights['L1'] > 0:
+            self.criterion_SSIM_L1 = pytorch_ssim.SSIML1(size_average=not track_per_sample_loss).to(device)
         if weights['D1'] > 0:
             self.criterion_D = nn.MSELoss().to(device)
         if weights['D2'] > 0:
@@ -116,47 +236,102 @@ class Generator(Model):
         self.scheduler = lr_scheduler.ReduceLROnPlateau(self.optimizer, factor=0.75, verbose=True, threshold=1e-8, patience=patience)
         self.device = device
         self.loss = {'SSIM': 1, 'L1': 1, 'D': 1, 'weighted': 1}
+        self.loss_tensors = {}
         self.compute_SSIM_anyway = compute_SSIM_anyway
 
-    def get_loss(self, pretty_printed=False):
+    # on_device: losses of the last batch as (detached) tensors, without synchronizing
+    def get_loss(self, pretty_printed=False, on_device=False):
+        if on_device:
+            return self.loss_tensors
         if pretty_printed:
             return ", ".join(["%s: %.3f"%(key, val) if val != 1 else 'NA' for key,val in self.loss.items()])
         return self.loss
 
+    def sync_losses(self):
+        if len(self.loss_tensors) > 0:
+            values = torch.stack([loss.reshape(()).float() for loss in self.loss_tensors.values()]).tolist()
+            self.loss.update(zip(self.loss_tensors.keys(), values))
+
+    def accepts_crop_size(self, size):
+        return Model.accepts_crop_size(self, size, same_size_output=True)
+
+    def get_per_sample_loss(self):
+        return self.per_sample_loss
+
     def denoise_batch(self, noisy_batch):
-        return self.model(noisy_batch)
+        with self.autocast():
+            return self.model(noisy_batch)
 
-    def learn(self, generated_batch_cropped, clean_batch_cropped, discriminator_predictions=None, discriminator2_predictions=None):
+    # the optimizer only steps if step is set (last batch of an accumulation window)
+    # discriminator(2)_loss: adversarial loss computed elsewhere (eg by a DiscriminatorWorker), used instead of
+    # discriminator(2)_predictions
+    def learn(self, generated_batch_cropped, clean_batch_cropped, discriminator_predictions=None, discriminator2_predictions=None,
+              step=True, discriminator_loss=None, discriminator2_loss=None):
+        # losses (and SSIM statistics) are computed in fp32
+        generated_batch_cropped = generated_batch_cropped.float()
+        if discriminator_predictions is not None:
+            discriminator_predictions = discriminator_predictions.float()
+        if discriminator2_predictions is not None:
+            discriminator2_predictions = discriminator2_predictions.float()
+        loss_tensors = {}
+        if self.track_per_sample_loss:
+            per_sample_loss = torch.zeros(generated_batch_cropped.shape[0], device=generated_batch_cropped.device)
+        if self.criterion_SSIM_L1 is not None:
+            loss_SSIM, loss_L1 = self.criterion_SSIM_L1(generated_batch_cropped, clean_batch_cropped)
         if self.weights['SSIM'] > 0 or self.compute_SSIM_anyway:
-            loss_SSIM = self.criterion_SSIM(generated_batch_cropped, clean_batch_cropped)
+            if self.criterion_SSIM_L1 is None:
+                loss_SSIM = self.criterion_SSIM(generated_batch_cropped, clean_batch_cropped)
             loss_SSIM = 1-loss_SSIM
-            self.loss['SSIM'] = loss_SSIM.item()
+            if self.track_per_sample_loss:
+                per_sample_loss += loss_SSIM.detach()*self.weights['SSIM']
+                loss_SSIM = loss_SSIM.mean()
+            loss_tensors['SSIM'] = loss_SSIM.detach()
         if self.weights['SSIM'] == 0:
-            loss_SSIM = torch.zeros(1).to(self.device)
+            loss_SSIM = torch.zeros(1, device=self.device)
         if self.weights['L1'] > 0:
-            loss_L1 = self.criterion_L1(generated_batch_cropped, clean_batch_cropped)
-            self.loss['L1'] = loss_L1.item()
+            if self.criterion_SSIM_L1 is None and self.track_per_sample_loss:
+                loss_L1 = (generated_batch_cropped-clean_batch_cropped).abs().mean((1, 2, 3))
+            elif self.criterion_SSIM_L1 is None:
+                loss_L1 = self.criterion_L1(generated_batch_cropped, clean_batch_cropped)
+            if self.track_per_sample_loss:
+                per_sample_loss += loss_L1.detach()*self.weights['L1']
+                loss_L1 = loss_L1.mean()
+            loss_tensors['L1'] = loss_L1.detach()
         else:
-            loss_L1 = torch.zeros(1).to(self.device)
-        if self.weights['D1'] > 0:
+            loss_L1 = torch.zeros(1, device=self.device)
+        if self.track_per_sample_loss:
+            self.per_sample_loss = per_sample_loss
+        if self.weights['D1'] > 0 and discriminator_loss is not None:
+            loss_D = discriminator_loss
+            loss_tensors['D'] = loss_D.detach().sqrt()
+        elif self.weights['D1'] > 0:
             loss_D = self.criterion_D(discriminator_predictions,
                                       gen_target_probabilities(True, discriminator_predictions.shape,
                                                                device=self.device, noisy=False))
-            self.loss['D'] = math.sqrt(loss_D.item())
+            loss_tensors['D'] = loss_D.detach().sqrt()
         else:
-            loss_D = torch.zeros(1).to(self.device)
-        if self.weights['D2'] > 0:
+            loss_D = torch.zeros(1, device=self.device)
+        if self.weights['D2'] > 0 and discriminator2_loss is not None:
+            loss_D2 = discriminator2_loss
+            loss_tensors['D2'] = loss_D2.detach().sqrt()
+        elif self.weights['D2'] > 0:
             loss_D2 = self.criterion_D2(discriminator2_predictions,
                                       gen_target_probabilities(True, discriminator2_predictions.shape,
                                                                device=self.device, noisy=False))
-            self.loss['D2'] = math.sqrt(loss_D2.item())
+            loss_tensors['D2'] = loss_D2.detach().sqrt()
         else:
-            loss_D2 = torch.zeros(1).to(self.device)
+            loss_D2 = torch.zeros(1, device=self.device)
         loss = loss_SSIM * self.weights['SSIM'] + loss_L1 * self.weights['L1'] + loss_D * self.weights['D1'] + loss_D2 * self.weights['D2']
-        self.loss['weighted'] = loss.item()
-        loss.backward()
-        self.optimizer.step()
-        self.optimizer.zero_grad()
+        loss_tensors['weighted'] = loss.detach()
+        self.loss_tensors = loss_tensors
+        self.learn_count += 1
+        if self.learn_count % self.loss_sync_interval == 0:
+            self.sync_losses()
+        self.scaler.scale(loss/self.accumulation_steps).backward()
+        if step:
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+            self.optimizer.zero_grad()
 
     def zero_grad(self):
         self.optimizer.zero_grad()
@@ -167,8 +342,15 @@ class Discriminator(Model):
                  model_path=None, device='cuda:0', loss_function='MSE',
                  activation='PReLU', funit=32, beta1=default_values['beta1'],
                  lr = default_values['lr'], not_conditional = False, printer=None, save_dict=True,
-                 patience=default_values['patience'], debug_options=[]):
-        Model.__init__(self, save_dict, device, printer, debug_options)
+                 patience=default_values['patience'], debug_options=[], precision='fp32', accumulation_steps=1,
+                 loss_sync_interval=1, fused_pass=False):
+        Model.__init__(self, save_dict, device, printer, debug_options, precision=precision,
+                       accumulation_steps=accumulation_steps, loss_sync_interval=loss_sync_interval)
+        # learn from the real and fake batches in a single forward/backward pass (batch normalization
+        # statistics are then computed over both)
+        self.fused_pass = fused_pass
+        # (generated batch, conditional fake batch) of the last learn call, reused by discriminate_batch
+        self.last_fake_batch = None
         self.device = device
         self.loss = 1
         self.loss_function = loss_function
@@ -178,38 +360,79 @@ class Discriminator(Model):
             input_channels = 3
         else:
             input_channels = 6
+        self.input_channels = input_channels
         self.model = self.instantiate_model(model_path=model_path, network=network, pfun=self.print, device=device, funit=funit, input_channels = input_channels)
             #elif network == 'PatchGAN':
             #    self.model = net_d = define_D(input_channels, 2*funit, 'basic', gpu_id=device)
         self.optimizer = optim.Adam(self.model.parameters(), lr=lr, betas=(beta1, 0.999))
         self.conditional = not not_conditional
         self.predictions_range = None
+        self.loss_tensor = None
+        self.predictions_range_tensor = None
         self.scheduler = lr_scheduler.ReduceLROnPlateau(self.optimizer, factor=0.75, verbose=True, threshold=1e-8, patience=patience)
 
-    def get_loss(self):
+    # on_device: loss of the last batch as a (detached) tensor, without synchronizing
+    def get_loss(self, on_device=False):
+        if on_device:
+            return self.loss_tensor
         return self.loss
 
+    def sync_losses(self):
+        if self.loss_tensor is None:
+            return
+        if self.predictions_range_tensor is None:
+            self.loss = self.loss_tensor.item()
+            self.predictions_range = '(not implemented)'
+        else:
+            values = torch.cat([self.loss_tensor.reshape(1), self.predictions_range_tensor]).tolist()
+            self.loss = values[0]
+            self.predictions_range = ", ".join(["{:.2}".format(value) for value in values[1:]])
+
+    def accepts_crop_size(self, size):
+        return Model.accepts_crop_size(self, size, input_channels=self.input_channels)
+
     def get_predictions_range(self):
         return 'range (r-r+f-f+): '+str(self.predictions_range)
 
     def update_loss(self, loss_fake, loss_real):
         if self.loss_function == 'MSE':
-            self.loss = (math.sqrt(loss_fake)+math.sqrt(loss_real))/2
+            self.loss_tensor = (loss_fake.sqrt()+loss_real.sqrt())/2
         else:
             self.print('Error: loss function not implemented: %s'%(self.loss_function))
 
+    # drop the fake batch kept by learn for discriminate_batch (and the generator's graph it references), when
+    # the generator does not learn from this batch
+    def release_fake_batch(self):
+        self.last_fake_batch = None
+
+    # predictions used in the generator loss. The discriminator's parameters are frozen (and its distributed
+    # wrapper bypassed) for this pass, so the generator's backward does not compute or synchronize
+    # discriminator gradients, which would otherwise pollute its accumulated gradients.
     def discriminate_batch(self, generated_batch_cropped, noisy_batch_cropped=None):
         if self.conditional:
-            fake_batch = torch.cat([noisy_batch_cropped, generated_batch_cropped], 1)
+            if self.last_fake_batch is not None and self.last_fake_batch[0] is generated_batch_cropped:
+                fake_batch = self.last_fake_batch[1]
+            else:
+                fake_batch = torch.cat([noisy_batch_cropped, generated_batch_cropped], 1)
+            self.last_fake_batch = None
         else:
             fake_batch = generated_batch_cropped
-        return self.model(fake_batch)
+        module = self.get_module()
+        module.requires_grad_(False)
+        try:
+            with self.autocast():
+                return module(fake_batch)
+        finally:
+            module.requires_grad_(True)
 
-    def learn(self, generated_batch_cropped, clean_batch_cropped, noisy_batch_cropped=None):
-        self.optimizer.zero_grad()
+    # the optimizer only steps if step is set (last batch of an accumulation window)
+    def learn(self, generated_batch_cropped, clean_batch_cropped, noisy_batch_cropped=None, step=True):
         if self.conditional:
             real_batch = torch.cat([noisy_batch_cropped, clean_batch_cropped], 1)
-            fake_batch = torch.cat([noisy_batch_cropped, generated_batch_cropped.detach()], 1)
+            # concatenated with the generated batch's graph once, discriminate_batch reuses it if the
+            # generator learns from the same batch
+            self.last_fake_batch = (generated_batch_cropped, torch.cat([noisy_batch_cropped, generated_batch_cropped], 1))
+            fake_batch = self.last_fake_batch[1].detach()
         else:
             real_batch = clean_batch_cropped
             fake_batch = generated_batch_cropped.detach()
@@ -225,25 +448,66 @@ class Discriminator(Model):
             torchvision.utils.save_image(real_batch_detached, batch_savename+'_real.png')
             torchvision.utils.save_image(fake_batch_detached, batch_savename+'_fake.png')
 
-        pred_real = self.model(real_batch)
+        if self.fused_pass:
+            with self.autocast():
+                predictions = self.model(torch.cat([real_batch, fake_batch], 0))
+            pred_real, pred_fake = predictions.float().split([real_batch.shape[0], fake_batch.shape[0]])
+        else:
+            with self.autocast():
+                pred_real = self.model(real_batch)
+            pred_real = pred_real.float()
         loss_real = self.criterion(pred_real,
                                    gen_target_probabilities(True, pred_real.shape,
                                                             device=self.device, noisy=True))
-        loss_real_detached = loss_real.item()
-        loss_real.backward()
-        pred_fake = self.model(fake_batch)
+        loss_real_detached = loss_real.detach()
+        if not self.fused_pass:
+            self.scaler.scale(loss_real/self.accumulation_steps).backward()
+            with self.autocast():
+                pred_fake = self.model(fake_batch)
+            pred_fake = pred_fake.float()
         loss_fake = self.criterion(pred_fake,
                                    gen_target_probabilities(False, pred_fake.shape,
                                                             device=self.device,
                                                             noisy=self.loss < 0.25))
-        loss_fake_detached = loss_fake.item()
-        loss_fake.backward()
+        loss_fake_detached = loss_fake.detach()
+        if self.fused_pass:
+            self.scaler.scale((loss_real+loss_fake)/self.accumulation_steps).backward()
+        else:
+            self.scaler.scale(loss_fake/self.accumulation_steps).backward()
         try:
-            self.predictions_range = ", ".join(["{:.2}".format(float(i)) for i in (pred_real.min(), pred_real.max(), pred_fake.min(), pred_fake.max())])
+            self.predictions_range_tensor = torch.stack([pred_real.min(), pred_real.max(), pred_fake.min(), pred_fake.max()]).detach()
         except:
-            self.predictions_range = '(not implemented)'
+            self.predictions_range_tensor = None
         self.update_loss(loss_fake_detached, loss_real_detached)
-        self.optimizer.step()
+        self.learn_count += 1
+        if self.learn_count % self.loss_sync_interval == 0:
+            self.sync_losses()
+        if step:
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+            self.optimizer.zero_grad()
+
+
+# the segment's forward runs a second time (in train mode) during backward, its batch normalization buffers
+# (running_mean, running_var, num_batches_tracked) are restored after that recomputation (also when it
+# stops early) so that they are only updated once per forward pass
+def checkpointed_forward(forward, batchnorms, *inputs):
+    if not torch.is_grad_enabled():
+        return forward(*inputs)
+    calls = [0]
+    def run(*inputs):
+        calls[0] += 1
+        if calls[0] == 1 or len(batchnorms) == 0:
+            return forward(*inputs)
+        buffers = [buffer for batchnorm in batchnorms for buffer in batchnorm.buffers(recurse=False)]
+        saved_buffers = [buffer.clone() for buffer in buffers]
+        try:
+            return forward(*inputs)
+        finally:
+            with torch.no_grad():
+                for buffer, saved_buffer in zip(buffers, saved_buffers):
+                    buffer.copy_(saved_buffer)
+    return checkpoint(run, *inputs, use_reentrant=False)
 
 
 class Printer:
@@ -262,6 +526,42 @@ class Printer:
             except Exception as e:
                 print('Warning: could not write to log: %s'%e)
 
+# Buffers typed metrics records (dictionaries of values, eg step, losses, learning rates, timing) in memory
+# and appends them to a JSON Lines file every flush_every records, instead of opening the log for every
+# message. Tensor values are only converted (synchronized) when the records are flushed. console is an
+# optional sink (eg print) which receives a human-readable line for every record that has one.
+# No file is written if file_path is None.
+class MetricsLogger:
+    def __init__(self, file_path=None, flush_every=100, console=None):
+        self.file_path = file_path
+        self.flush_every = flush_every
+        self.console = console
+        self.records = []
+
+    def log(self, record_type, console_line=None, **values):
+        if self.console is not None and console_line is not None:
+            self.console(console_line)
+        if self.file_path is None:
+            return
+        values['type'] = record_type
+        values['time'] = time.time()
+        self.records.append(values)
+        if len(self.records) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if len(self.records) == 0:
+            return
+        lines = []
+        for record in self.records:
+            lines.append(json.dumps({key: float(value) if isinstance(value, torch.Tensor) else value for key, value in record.items()}))
+        self.records = []
+        try:
+            with open(self.file_path, 'a') as f:
+                f.write('\n'.join(lines)+'\n')
+        except Exception as e:
+            print('Warning: could not write metrics: %s'%e)
+
 def get_crop_boundaries(cs, ucs, network=None, discriminator=None):
     # if '112' in discriminator:
     #     loss_crop_lb = int((cs-112)/2)
@@ -280,21 +580,29 @@ def get_crop_boundaries(cs, ucs, network=None, discriminator=None):
     assert (loss_crop_up - loss_crop_lb) <= ucs
     return loss_crop_lb, loss_crop_up
 
+# noise-free targets are constant, they are allocated once per shape and device and reused (not to be
+# modified in place). Only the most recently used ones are kept (shapes change with the crop size and batch
+# size). Noisy targets are generated directly on the device.
+constant_target_probabilities = OrderedDict()
+constant_target_probabilities_max = 8
+constant_target_probabilities_lock = threading.Lock()
+
 def gen_target_probabilities(target_real, target_probabilities_shape, device=None, invert_probabilities=False, noisy = True):
-    if (target_real and not invert_probabilities) or (not target_real and invert_probabilities):
-        if noisy:
-            res = 19/20+torch.rand(target_probabilities_shape)/20
-        else:
-            res = torch.ones(target_probabilities_shape)
-    else:
-        if noisy:
-            res = torch.rand(target_probabilities_shape)/20
-        else:
-            res = torch.zeros(target_probabilities_shape)
-    if device is None:
-        return res
-    else:
-        return res.to(device)
+    positive = (target_real and not invert_probabilities) or (not target_real and invert_probabilities)
+    if not noisy:
+        key = (positive, tuple(target_probabilities_shape), str(device))
+        with constant_target_probabilities_lock:
+            if key in constant_target_probabilities:
+                constant_target_probabilities.move_to_end(key)
+                return constant_target_probabilities[key]
+            if len(constant_target_probabilities) >= constant_target_probabilities_max:
+                constant_target_probabilities.popitem(last=False)
+            constant_target_probabilities[key] = torch.full(target_probabilities_shape, 1. if positive else 0., device=device)
+            return constant_target_probabilities[key]
+    res = torch.rand(target_probabilities_shape, device=device)/20
+    if positive:
+        res += 19/20
+    return res
 
 
 def get_weights(args):
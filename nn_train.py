@@ -3,60 +3,74 @@
 from __future__ import print_function
 import argparse
 import os
-from dataset_torch_3 import DenoisingDataset
+from dataset_torch_3 import DenoisingDataset, collate_iso_groups
 import time
 import datetime
 import sys
 
 import torch
-from torch.utils.data import DataLoader
+import torch.distributed as dist
+from torch.utils.data import DataLoader, WeightedRandomSampler, DistributedSampler
 import torch.backends.cudnn as cudnn
 import random
-import statistics
-from nn_common import default_values, Generator, Discriminator, Printer, get_crop_boundaries, get_weights
+import atexit
+import tempfile
+from augmentation import BatchAugmenter
+from prefetch_loader import DevicePrefetcher
+from checkpoint_writer import CheckpointWriter
+from generator_output_cache import GeneratorOutputCache
+from hard_example_sampler import HardExampleBatchSampler
+from discriminator_worker import DiscriminatorWorker
+from train_options import add_training_arguments, add_generator_arguments
+from batch_size_finder import find_batch_size, probe_training_step, get_optimizer_state_bytes
+from nn_common import default_values, Generator, Discriminator, Printer, MetricsLogger, get_crop_boundaries, get_weights
 
 # Training settings
 
 parser = argparse.ArgumentParser(description='(c)GAN trainer for mthesis-denoise')
-parser.add_argument('--batch_size', type=int, default=18, help='Training batch size')
-parser.add_argument('--time_limit', type=int, default=172800, help='Time limit (ends training)')
-parser.add_argument('--g_activation', type=str, default='PReLU', help='Final activation function for generator')
-parser.add_argument('--g_funit', type=int, default=32, help='Filter unit size for generator')
+add_training_arguments(parser)
+add_generator_arguments(parser)
 parser.add_argument('--d_activation', type=str, default='PReLU', help='Final activation function for discriminator')
 parser.add_argument('--d2_activation', type=str, default='PReLU', help='Final activation function for discriminator')
 parser.add_argument('--d_funit', type=int, default=32, help='Filter unit size for discriminator')
 parser.add_argument('--d2_funit', type=int, default=32, help='Filter unit size for discriminator')
 parser.add_argument('--d_model_path', help='Discriminator pretrained model path (.pth for model, .pt for dictionary)')
 parser.add_argument('--d2_model_path', help='Discriminator pretrained model path (.pth for model, .pt for dictionary)')
-parser.add_argument('--g_model_path', help='Generator pretrained model path (.pth for model, .pt for dictionary)')
-parser.add_argument('--beta1', type=float, default=default_values['beta1'], help='beta1 for adam. default=%f'%default_values['beta1'])
 parser.add_argument('--d_loss_function', type=str, default='MSE', help='Discriminator loss function')
 parser.add_argument('--d2_loss_function', type=str, default='MSE', help='Discriminator loss function')
 parser.add_argument('--d_lr', type=float, default=default_values['lr'], help='Initial learning rate for adam (discriminator)')
 parser.add_argument('--d2_lr', type=float, default=default_values['lr'], help='Initial learning rate for adam (discriminator)')
-parser.add_argument('--g_lr', type=float, default=default_values['lr'], help='Initial learning rate for adam (generator)')
-parser.add_argument('--weight_SSIM', type=float, help='Weight on SSIM term in objective')
-parser.add_argument('--weight_L1', type=float, help='Weight on L1 term in objective')
 parser.add_argument('--weight_D1', type=float, help='Weight on Discriminator 1 term in objective')
 parser.add_argument('--weight_D2', type=float, help='Weight on Discriminator 2 term in objective')
-parser.add_argument('--test_reserve', nargs='*', help='Space separated list of image sets to be reserved for testing')
-parser.add_argument('--train_data', nargs='*', help="(space-separated) Path(s) to the pre-cropped training data (default: %s)"%(" ".join(default_values['train_data'])))
 parser.add_argument('--debug_options', nargs='*', help="(space-separated) Debug options (available: discriminator_input)")
-parser.add_argument('--cuda_device', default=0, type=int, help='Device number (default: 0, typically 0-3, -1 for CPU)')
 parser.add_argument('--d_network', type=str, default=default_values['d_network'], help='Discriminator network (default: %s)'%default_values['d_network'])
 parser.add_argument('--d2_network', type=str, default=default_values['d2_network'], help='Discriminator2 network (default: %s)'%default_values['d2_network'])
-parser.add_argument('--g_network', type=str, default=default_values['g_network'], help='Generator network (default: %s)'%default_values['g_network'])
-parser.add_argument('--threads', type=int, default=6, help='Number of threads for data loader to use')
-parser.add_argument('--min_lr', type=float, default=0.00000005, help='Minimum learning rate (ends training)')
 parser.add_argument('--not_conditional', action='store_true', help='Regular GAN instead of cGAN')
 parser.add_argument('--not_conditional_2', action='store_true', help='Regular GAN instead of cGAN')
-parser.add_argument('--epochs', type=int, default=9001, help='Number of epochs (ends training)')
-parser.add_argument('--compute_SSIM_anyway', action='store_true', help='Compute and display SSIM loss even if not used')
 parser.add_argument('--freeze_generator', action='store_true', help='Freeze generator until discriminator is useful')
-parser.add_argument('--start_epoch', default=1, type=int, help='Starting epoch (cosmetics)')
 parser.add_argument('--discriminator_advantage', type=float, default=0.0, help='Desired discriminator correct prediction ratio is 0.5+advantage')
 parser.add_argument('--discriminator2_advantage', type=float, default=0.0, help='Desired discriminator correct prediction ratio is 0.5+advantage')
-parser.add_argument('--patience', type=int, default=default_values['patience'], help='Number of epochs without improvements before scheduler updates learning rate')
+parser.add_argument('--iso_group_size', type=int, default=1, help='Number of noisy crops paired with each loaded clean crop (batch_size must be a multiple of it, default: 1)')
+parser.add_argument('--min_crop_variance', type=float, default=0, help='Skip crops whose clean variance is lower (requires crop_stats.py output)')
+parser.add_argument('--min_crop_edge_energy', type=float, default=0, help='Skip crops whose clean edge energy is lower (requires crop_stats.py output)')
+parser.add_argument('--weight_crops_by', type=str, help='Sample crops proportionally to a crop statistic (mean, variance, edge_energy, noise) instead of uniformly (requires crop_stats.py output)')
+parser.add_argument('--crop_weight_power', type=float, default=1, help='Power applied to the --weight_crops_by statistic (default: 1)')
+parser.add_argument('--hard_example_sampling', action='store_true', help='Oversample crops with a high recent generator (SSIM+L1) loss')
+parser.add_argument('--hard_example_temperature', type=float, default=1.0, help='Temperature of the softmax over normalized crop losses with --hard_example_sampling (lower is greedier, default: 1.0)')
+parser.add_argument('--hard_example_floor', type=float, default=0.2, help='Share of the sampling probability spread uniformly over all crops with --hard_example_sampling (default: 0.2)')
+parser.add_argument('--crop_size_schedule', nargs='*', help='(space-separated) epoch:crop_size milestones, train on random crop_size sub-crops of the dataset crops from that epoch on (eg 1:64 10:96 20:128, default: full crops)')
+parser.add_argument('--distributed', action='store_true', help='Distributed data-parallel training, one process per device/host launched with torchrun (batch_size and threads are per process)')
+parser.add_argument('--dist_backend', type=str, default='gloo', help='torch.distributed backend with --distributed (default: gloo, nccl for CUDA only)')
+parser.add_argument('--checkpoint_segments', nargs='*', help="(space-separated) Blocks (network attribute names, eg enc128to126std dec126to128std or down1 up4, 'all' for every block) whose activations are recomputed during backward instead of stored, in every network which has them. Trades compute for memory (larger batches)")
+parser.add_argument('--accumulation_steps', type=int, default=1, help='Number of batches whose gradients are accumulated per optimizer step, the effective batch size is batch_size*accumulation_steps (default: 1)')
+parser.add_argument('--resume', type=str, help='Resume training from the last epoch saved in a model directory (models/<expname>, continues its logs and checkpoints)')
+parser.add_argument('--loss_sync_interval', type=int, default=1, help='Losses stay on the training device and are only read back every this many batches (per network), learning decisions then use losses up to this many batches old and the console summary is printed at this interval (default: 1)')
+parser.add_argument('--fused_discriminator_pass', action='store_true', help='Discriminators learn from the real and fake batches in a single forward/backward pass (batch normalization statistics are computed over both)')
+parser.add_argument('--warmup_samples', type=int, default=0, help='With --freeze_generator, run the frozen generator once over this many crops, cache the (noisy, generated, clean) crops in a temporary file (in --warmup_cache_dir) and train the discriminator(s) from that cache first (default: 0, disabled)')
+parser.add_argument('--warmup_cache_dir', type=str, help='Directory of the --warmup_samples cache, which is deleted after the warm-up (default: the system temporary directory)')
+parser.add_argument('--warmup_epochs', type=int, default=10, help='Number of discriminator passes over the --warmup_samples cache (default: 10)')
+parser.add_argument('--discriminator_devices', nargs='*', type=int, help="(space-separated) Run discriminator and discriminator2 in background workers on these devices (device numbers as --cuda_device, -1 for CPU, default: the generator's device). The generator's adversarial losses are then computed before the discriminators learn from the same batch, so that their updates overlap with the generator's")
+parser.add_argument('--memory_fraction', type=float, default=0.9, help="Share of the device's memory (CPU: of the available memory) used with --batch_size auto (default: 0.9)")
 
 args = parser.parse_args()
 
@@ -70,6 +84,14 @@ if args.train_data is None or args.train_data == []:
     train_data = default_values['train_data']
 else:
     train_data = args.train_data
+if args.distributed:
+    # RANK, WORLD_SIZE, LOCAL_RANK, MASTER_ADDR and MASTER_PORT are set by torchrun
+    dist.init_process_group(backend=args.dist_backend, init_method='env://')
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    if args.cuda_device >= 0 and torch.cuda.is_available():
+        args.cuda_device = int(os.environ.get('LOCAL_RANK', 0)) % torch.cuda.device_count()
+else:
+    rank, world_size = 0, 1
 if args.cuda_device >= 0 and torch.cuda.is_available():
     torch.cuda.set_device(args.cuda_device)
     device = torch.device("cuda:"+str(args.cuda_device))
@@ -80,61 +102,326 @@ if args.debug_options is None or args.debug_options == []:
 else:
     debug_options = args.debug_options
 
+if args.uint8_transport:
+    args.batched_augmentation = True
+discriminator_workers = args.discriminator_devices is not None
+assert not (discriminator_workers and args.distributed)
+# device of discriminator (0) or discriminator2 (1)
+def discriminator_device(index):
+    if not discriminator_workers or len(args.discriminator_devices) <= index:
+        return device
+    if args.discriminator_devices[index] >= 0 and torch.cuda.is_available():
+        return torch.device("cuda:"+str(args.discriminator_devices[index]))
+    return torch.device('cpu')
+
 weights = get_weights(args)
 use_D = weights['D1'] > 0
 use_D2 = weights['D2'] > 0
+if args.warmup_samples > 0 and args.distributed:
+    parser.error('--warmup_samples is not supported with distributed training')
+if args.warmup_samples > 0 and not (use_D or use_D2):
+    parser.error('--warmup_samples requires a discriminator (--weight_D1 or --weight_D2)')
+
+
+# training decisions (and stopping conditions) taken by rank 0, so that every process runs the same
+# forward/backward passes and gradients can be synchronized
+def rank0_decisions(*decisions):
+    if not args.distributed:
+        return decisions
+    decisions = torch.tensor(decisions, dtype=torch.uint8, device=device if args.dist_backend == 'nccl' else 'cpu')
+    dist.broadcast(decisions, 0)
+    return [bool(decision) for decision in decisions.tolist()]
 
+# mean of on-device loss tensors (without synchronizing)
+def average_losses(losses):
+    return torch.stack([loss.reshape(()) for loss in losses]).mean()
+
+# average of a per-process value over all processes
+def average_over_ranks(value):
+    if not args.distributed:
+        return value
+    value = torch.tensor([value], dtype=torch.float64, device=device if args.dist_backend == 'nccl' else 'cpu')
+    dist.all_reduce(value)
+    return value.item()/world_size
 
 def crop_batch(batch, boundaries):
     return batch[:, :, boundaries[0]:boundaries[1], boundaries[0]:boundaries[1]]
 
+# same random size x size sub-crop of every (clean, noisy) batch
+def random_crop_batches(batches, size):
+    if size == batches[0].shape[2]:
+        return batches
+    x0 = random.randint(0, batches[0].shape[3]-size)
+    y0 = random.randint(0, batches[0].shape[2]-size)
+    return [batch[:, :, y0:y0+size, x0:x0+size] for batch in batches]
+
 
 cudnn.benchmark = True
 
 torch.manual_seed(123)
 torch.cuda.manual_seed(123)
 
-expname = (datetime.datetime.now().isoformat()[:-10]+'_'+'_'.join(sys.argv).replace('/','-'))[0:255]
-model_dir = os.path.join('models', expname)
+if args.resume is not None:
+    model_dir = os.path.normpath(args.resume if os.path.isdir(args.resume) else os.path.join('models', args.resume))
+    expname = os.path.basename(model_dir)
+else:
+    expname = (datetime.datetime.now().isoformat()[:-10]+'_'+'_'.join(sys.argv).replace('/','-'))[0:255]
+    model_dir = os.path.join('models', expname)
+# kept in a subdirectory so that model lookups in model_dir (highest *_<epoch>.pt) only see checkpoints
+training_state_path = os.path.join(model_dir, 'resume', 'training_state.pt')
 txt_path = os.path.join('results', 'train', expname)
-os.makedirs(model_dir, exist_ok=True)
+if rank == 0:
+    os.makedirs(os.path.dirname(training_state_path), exist_ok=True)
 
 frozen_generator = args.freeze_generator
+# the discriminator warm-up only runs once (not again when resuming)
+warmup_done = False
+
+# only rank 0 logs
+p = Printer(tostdout=rank == 0, tofile=rank == 0, file_path=os.path.join(txt_path))
 
-p = Printer(file_path=os.path.join(txt_path))
+# per-step (and per-epoch) metrics records are buffered and written to <txt_path>.jsonl
+metrics = MetricsLogger(file_path=txt_path+'.jsonl' if rank == 0 else None, flush_every=args.metrics_flush_every,
+                        console=print if rank == 0 and not args.quiet else None)
+atexit.register(metrics.flush)
+
+# checkpoints are written in the background, pending ones are completed before exiting
+if rank == 0:
+    checkpoint_writer = CheckpointWriter(printer=p)
+    atexit.register(checkpoint_writer.close)
 
 p.print(args)
 p.print("cmd: python3 "+" ".join(sys.argv))
 
-DDataset = DenoisingDataset(train_data, test_reserve=test_reserve)
-data_loader = DataLoader(dataset=DDataset, num_workers=args.threads, drop_last=True,
-                         batch_size=args.batch_size, shuffle=True)
+DDataset = DenoisingDataset(train_data, test_reserve=test_reserve, cache_bytes=args.crop_cache_mb*1048576,
+                            batched_augmentation=args.batched_augmentation, return_uint8=args.uint8_transport,
+                            iso_group_size=args.iso_group_size, crop_stats=args.weight_crops_by is not None,
+                            min_crop_variance=args.min_crop_variance, min_crop_edge_energy=args.min_crop_edge_energy)
 
+DiscriminatorClass = DiscriminatorWorker if discriminator_workers else Discriminator
 if use_D:
-    discriminator = Discriminator(network=args.d_network, model_path=args.d_model_path,
-                                  device=device, loss_function=args.d_loss_function,
-                                  activation=args.d_activation, funit=args.d_funit,
-                                  beta1=args.beta1, lr=args.d_lr,
-                                  not_conditional=args.not_conditional, printer=p,
-                                  patience=args.patience, debug_options=debug_options)
+    discriminator = DiscriminatorClass(network=args.d_network, model_path=args.d_model_path,
+                                       device=discriminator_device(0), loss_function=args.d_loss_function,
+                                       activation=args.d_activation, funit=args.d_funit,
+                                       beta1=args.beta1, lr=args.d_lr,
+                                       not_conditional=args.not_conditional, printer=p,
+                                       patience=args.patience, debug_options=debug_options,
+                                       precision=args.precision, accumulation_steps=args.accumulation_steps,
+                                       loss_sync_interval=args.loss_sync_interval, fused_pass=args.fused_discriminator_pass)
 if use_D2:
-    discriminator2 = Discriminator(network=args.d2_network, model_path=args.d2_model_path,
-                                  device=device, loss_function=args.d2_loss_function,
-                                  activation=args.d2_activation, funit=args.d2_funit,
-                                  beta1=args.beta1, lr=args.d2_lr,
-                                  not_conditional=args.not_conditional_2, printer=p,
-                                  patience=args.patience, debug_options=debug_options)
+    discriminator2 = DiscriminatorClass(network=args.d2_network, model_path=args.d2_model_path,
+                                       device=discriminator_device(1), loss_function=args.d2_loss_function,
+                                       activation=args.d2_activation, funit=args.d2_funit,
+                                       beta1=args.beta1, lr=args.d2_lr,
+                                       not_conditional=args.not_conditional_2, printer=p,
+                                       patience=args.patience, debug_options=debug_options,
+                                       precision=args.precision, accumulation_steps=args.accumulation_steps,
+                                       loss_sync_interval=args.loss_sync_interval, fused_pass=args.fused_discriminator_pass)
+if discriminator_workers:
+    for model in (discriminator if use_D else None, discriminator2 if use_D2 else None):
+        if model is not None:
+            atexit.register(model.close)
 generator = Generator(network=args.g_network, model_path=args.g_model_path, device=device,weights=weights,
                       activation=args.g_activation, funit=args.g_funit, beta1=args.beta1,
                       lr=args.g_lr, printer=p, compute_SSIM_anyway=args.compute_SSIM_anyway,
-                      patience=args.patience, debug_options=debug_options)
+                      patience=args.patience, debug_options=debug_options,
+                      track_per_sample_loss=args.hard_example_sampling, precision=args.precision,
+                      accumulation_steps=args.accumulation_steps, loss_sync_interval=args.loss_sync_interval)
+
+# crop size used from each epoch milestone on, the useful (loss) area is scaled accordingly
+crop_size_schedule = {1: DDataset.cs}
+if args.crop_size_schedule is not None:
+    for milestone in args.crop_size_schedule:
+        milestone_epoch, milestone_cs = [int(i) for i in milestone.split(':')]
+        assert milestone_cs <= DDataset.cs
+        crop_size_schedule[milestone_epoch] = milestone_cs
+def get_crop_size(epoch):
+    return crop_size_schedule[max(milestone for milestone in crop_size_schedule if milestone <= epoch)]
+def get_scaled_crop_boundaries(cs):
+    return get_crop_boundaries(cs, DDataset.ucs*cs//DDataset.cs, network=args.g_network, discriminator=args.d_network)
+for cs in sorted(set(crop_size_schedule.values())):
+    loss_crop_lb, loss_crop_up = get_scaled_crop_boundaries(cs)
+    loss_cs = loss_crop_up-loss_crop_lb
+    if not generator.accepts_crop_size(cs):
+        p.print('Error: %s does not accept %ux%u crops' % (args.g_network, cs, cs))
+        exit(1)
+    for network, model in ((args.d_network, discriminator if use_D else None), (args.d2_network, discriminator2 if use_D2 else None)):
+        if model is not None and not model.accepts_crop_size(loss_cs):
+            p.print('Error: %s does not accept %ux%u crops' % (network, loss_cs, loss_cs))
+            exit(1)
+crop_size = None
+if args.checkpoint_segments is not None:
+    checkpointed_segments = set()
+    for network, model in ((args.g_network, generator), (args.d_network, discriminator if use_D else None), (args.d2_network, discriminator2 if use_D2 else None)):
+        if model is not None:
+            segments = model.checkpoint_segments(args.checkpoint_segments)
+            checkpointed_segments.update(segments)
+            p.print('Activation checkpointing in %s: %s' % (network, ', '.join(segments) if len(segments) > 0 else 'none'))
+    unknown_segments = set(args.checkpoint_segments) - checkpointed_segments - {'all'}
+    if len(unknown_segments) > 0:
+        p.print('Error: unknown checkpoint segments: %s' % ', '.join(unknown_segments))
+        exit(1)
+if args.batch_size == 'auto':
+    # probed on the largest scheduled crops, discriminators run by workers on other devices are not included
+    def probed_discriminator(model, used):
+        if not used or (discriminator_workers and model.device != device):
+            return None
+        return model.discriminator if discriminator_workers else model
+    probed_discriminators = [probed_discriminator(discriminator if use_D else None, use_D),
+                             probed_discriminator(discriminator2 if use_D2 else None, use_D2)]
+    probed_crop_size = max(crop_size_schedule.values())
+    batch_size_description = 'training G %s(%u) %s, %ux%u crops, %s%s' % (
+        args.g_network, args.g_funit, ' '.join(['D %s(%u)' % (network, funit) for network, funit, used in (
+            (args.d_network, args.d_funit, use_D), (args.d2_network, args.d2_funit, use_D2)) if used]),
+        probed_crop_size, probed_crop_size, args.precision,
+        ', checkpointed '+' '.join(args.checkpoint_segments) if args.checkpoint_segments else '')
+    args.batch_size = find_batch_size(probe_training_step(generator, probed_discriminators[0], probed_discriminators[1],
+                                                          probed_crop_size, get_scaled_crop_boundaries(probed_crop_size), device),
+                                      device, batch_size_description, memory_fraction=args.memory_fraction,
+                                      max_batch_size=len(DDataset)*args.iso_group_size, printer=p,
+                                      extra_bytes=get_optimizer_state_bytes([model for model in [generator]+probed_discriminators
+                                                                             if model is not None]))
+    if args.distributed:
+        batch_size = torch.tensor([args.batch_size], device=device if args.dist_backend == 'nccl' else 'cpu')
+        dist.all_reduce(batch_size, op=dist.ReduceOp.MIN)
+        args.batch_size = int(batch_size.item())
+    args.batch_size = max(args.batch_size//args.iso_group_size, 1)*args.iso_group_size
+    p.print('Training batch size: %u' % args.batch_size)
+assert args.batch_size % args.iso_group_size == 0
+if args.distributed:
+    # each process trains on its own shard of the dataset
+    assert not args.hard_example_sampling and args.weight_crops_by is None
+    distributed_sampler = DistributedSampler(DDataset, num_replicas=world_size, rank=rank, shuffle=True, drop_last=True)
+    loader_sampling = {'sampler': distributed_sampler, 'batch_size': args.batch_size//args.iso_group_size, 'drop_last': True}
+elif args.hard_example_sampling:
+    assert args.weight_crops_by is None
+    hard_example_sampler = HardExampleBatchSampler(len(DDataset), args.batch_size//args.iso_group_size,
+                                                   temperature=args.hard_example_temperature,
+                                                   uniform_floor=args.hard_example_floor, device=device)
+    loader_sampling = {'batch_sampler': hard_example_sampler}
+elif args.weight_crops_by is not None:
+    loader_sampling = {'sampler': WeightedRandomSampler(DDataset.get_crop_weights(args.weight_crops_by, args.crop_weight_power), len(DDataset)),
+                       'batch_size': args.batch_size//args.iso_group_size, 'drop_last': True}
+else:
+    loader_sampling = {'batch_size': args.batch_size//args.iso_group_size, 'drop_last': True, 'shuffle': True}
+data_loader = DataLoader(dataset=DDataset, num_workers=args.threads,
+                         pin_memory=args.uint8_transport and device.type == 'cuda',
+                         collate_fn=collate_iso_groups if args.iso_group_size > 1 else None, **loader_sampling)
+if args.batched_augmentation:
+    augmenter = BatchAugmenter(device)
+
+def load_batch(batch):
+    if args.batched_augmentation:
+        return augmenter(batch[0], batch[1], batch[2])
+    return batch[0].to(device, non_blocking=True), batch[1].to(device, non_blocking=True)
 
-crop_boundaries = get_crop_boundaries(DDataset.cs, DDataset.ucs, network=args.g_network, discriminator=args.d_network)
+batches = DevicePrefetcher(data_loader, device, prefetch=args.prefetch, transform=load_batch)
+
+if args.distributed:
+    generator.distribute()
+    if use_D:
+        discriminator.distribute()
+    if use_D2:
+        discriminator2.distribute()
 
 
+if args.resume is not None:
+    training_state = torch.load(training_state_path, map_location='cpu')
+    generator.load_training_state(training_state['generator'])
+    if use_D:
+        discriminator.load_training_state(training_state['discriminator'])
+    if use_D2:
+        discriminator2.load_training_state(training_state['discriminator2'])
+    if args.hard_example_sampling and training_state.get('hard_example_losses') is not None:
+        hard_example_sampler.losses.copy_(training_state['hard_example_losses'])
+    frozen_generator = training_state['frozen_generator']
+    warmup_done = training_state.get('warmup_done', False)
+    random.setstate(training_state['rng']['random'])
+    torch.set_rng_state(training_state['rng']['torch'])
+    if torch.cuda.is_available() and training_state['rng']['cuda'] is not None:
+        torch.cuda.set_rng_state_all(training_state['rng']['cuda'])
+    args.start_epoch = training_state['epoch']+1
+    p.print('Resuming training from %s (epoch %u)' % (training_state_path, args.start_epoch))
+
+trained_models = [model for model, used in ((generator, True), (discriminator if use_D else None, use_D),
+                                           (discriminator2 if use_D2 else None, use_D2)) if used]
+num_steps = (len(batches)+args.accumulation_steps-1)//args.accumulation_steps
+
+# discriminator warm-up: train the discriminator(s) from cached outputs of the frozen generator instead of
+# running it on every batch until the discriminator is useful
+if args.warmup_samples > 0 and frozen_generator and not warmup_done:
+    warmup_crop_size = get_crop_size(args.start_epoch)
+    warmup_crop_boundaries = get_scaled_crop_boundaries(warmup_crop_size)
+    warmup_loss_cs = warmup_crop_boundaries[1]-warmup_crop_boundaries[0]
+    warmup_cache_file, warmup_cache_path = tempfile.mkstemp(prefix='warmup_cache_', suffix='.npy', dir=args.warmup_cache_dir)
+    os.close(warmup_cache_file)
+    warmup_cache = GeneratorOutputCache(warmup_cache_path, args.warmup_samples, (3, warmup_loss_cs, warmup_loss_cs))
+    atexit.register(warmup_cache.close)
+    p.print('Discriminator warm-up: caching %u generator outputs in %s' % (args.warmup_samples, warmup_cache.path))
+    with torch.no_grad():
+        while not warmup_cache.is_full():
+            cached_samples = len(warmup_cache)
+            for clean_batch, noisy_batch in batches:
+                clean_batch, noisy_batch = random_crop_batches((clean_batch, noisy_batch), warmup_crop_size)
+                generated_batch = generator.denoise_batch(noisy_batch)
+                warmup_cache.add(crop_batch(noisy_batch, warmup_crop_boundaries),
+                                 crop_batch(generated_batch, warmup_crop_boundaries),
+                                 crop_batch(clean_batch, warmup_crop_boundaries))
+                if warmup_cache.is_full():
+                    break
+            if len(warmup_cache) == cached_samples:
+                p.print('Error: the data loader yields no batches, cannot fill the warm-up cache')
+                exit(1)
+    warmup_cache.flush()
+    warmup_num_batches = len(warmup_cache)//args.batch_size
+    for warmup_epoch in range(1, args.warmup_epochs+1):
+        warmup_losses = {'D': [], 'D2': []}
+        for iteration, (noisy_batch_cropped, generated_batch_cropped, clean_batch_cropped) in enumerate(warmup_cache.batches(args.batch_size, device), 1):
+            if (iteration-1) % args.accumulation_steps == 0:
+                for model in trained_models[1:]:
+                    model.set_accumulation_steps(min(args.accumulation_steps, warmup_num_batches-iteration+1))
+            if use_D:
+                discriminator.learn(noisy_batch_cropped=noisy_batch_cropped,
+                                    generated_batch_cropped=generated_batch_cropped,
+                                    clean_batch_cropped=clean_batch_cropped,
+                                    step=iteration % args.accumulation_steps == 0 or iteration == warmup_num_batches)
+                if not discriminator_workers:
+                    warmup_losses['D'].append(discriminator.get_loss(on_device=True))
+            if use_D2:
+                discriminator2.learn(noisy_batch_cropped=noisy_batch_cropped,
+                                     generated_batch_cropped=generated_batch_cropped,
+                                     clean_batch_cropped=clean_batch_cropped,
+                                     step=iteration % args.accumulation_steps == 0 or iteration == warmup_num_batches)
+                if not discriminator_workers:
+                    warmup_losses['D2'].append(discriminator2.get_loss(on_device=True))
+        if discriminator_workers:
+            warmup_losses = {'D': discriminator.collect_losses() if use_D else [],
+                             'D2': discriminator2.collect_losses() if use_D2 else []}
+        p.print('Discriminator warm-up epoch %u/%u: %s' % (warmup_epoch, args.warmup_epochs, ', '.join(
+            ['average loss %s: %f' % (key, average_losses(losses).item()) for key, losses in warmup_losses.items() if len(losses) > 0])))
+    for model in trained_models[1:]:
+        model.sync_losses()
+        model.release_fake_batch()
+    warmup_cache.close()
+    warmup_done = True
+    frozen_generator = ((not use_D) or discriminator.get_loss() > 0.33) and ((not use_D2) or discriminator2.get_loss() > 0.33)
+    p.print('Discriminator warm-up done, generator is %s' % ('still frozen' if frozen_generator else 'unfrozen'))
+
+# whether the generator learns in this accumulation window (the less useful the discriminators, the less likely)
+def decide_generator_learns(discriminator_learns, discriminator2_learns):
+    generator_learns = not frozen_generator and (
+        (not discriminator_learns and not discriminator2_learns)
+        or (discriminator_learns and discriminator2_learns and (discriminator2.get_loss()+args.discriminator2_advantage+discriminator.get_loss()+args.discriminator_advantage)/2 < random.random())
+        or (discriminator_learns and (not discriminator2_learns) and discriminator.get_loss()+args.discriminator_advantage < random.random())
+        or (discriminator2_learns and (not discriminator_learns) and discriminator2.get_loss()+args.discriminator2_advantage < random.random())
+        )
+    generator_learns, = rank0_decisions(generator_learns)
+    return generator_learns
+
 discriminator_predictions = None
-generator_learning_rate = args.g_lr
-discriminator_learning_rate = args.d_lr
+discriminator2_predictions = None
+generator_learning_rate = generator.optimizer.param_groups[0]['lr']
+discriminator_learning_rate = discriminator.get_learning_rate() if use_D else args.d_lr
 
 start_time = time.time()
 for epoch in range(args.start_epoch, args.epochs):
@@ -143,40 +430,72 @@ for epoch in range(args.start_epoch, args.epochs):
     loss_G_list = []
     loss_G_SSIM_list = []
     epoch_start_time = time.time()
-    for iteration, batch in enumerate(data_loader, 1):
-        iteration_summary = 'Epoch %u batch %u/%u: ' % (epoch, iteration, len(data_loader))
-        clean_batch_cropped = crop_batch(batch[0].to(device), crop_boundaries)
-        noisy_batch = batch[1].to(device)
+    if args.distributed:
+        distributed_sampler.set_epoch(epoch)
+    if get_crop_size(epoch) != crop_size:
+        crop_size = get_crop_size(epoch)
+        p.print('Training on %ux%u crops' % (crop_size, crop_size))
+        crop_boundaries = get_scaled_crop_boundaries(crop_size)
+    for iteration, (clean_batch, noisy_batch) in enumerate(batches, 1):
+        # optimizers step once per window of accumulation_steps batches (or at the end of the epoch), which
+        # networks learn is decided on the first batch of a window and held for the whole window
+        window_start = (iteration-1) % args.accumulation_steps == 0
+        window_end = iteration % args.accumulation_steps == 0 or iteration == len(batches)
+        if window_start:
+            window_losses = {'D': [], 'D2': [], 'G': [], 'G_SSIM': []}
+            step_start_time = time.time()
+            for model in trained_models:
+                model.set_accumulation_steps(min(args.accumulation_steps, len(batches)-iteration+1))
+        if args.distributed:
+            for model in trained_models:
+                model.set_gradient_sync(window_end)
+        iteration_summary = 'Epoch %u batch %u/%u: ' % (epoch, (iteration-1)//args.accumulation_steps+1, num_steps)
+        clean_batch, noisy_batch = random_crop_batches((clean_batch, noisy_batch), crop_size)
+        if args.hard_example_sampling:
+            batch_indices = hard_example_sampler.pop_batch()
+        clean_batch_cropped = crop_batch(clean_batch, crop_boundaries)
         noisy_batch_cropped = crop_batch(noisy_batch, crop_boundaries)
         generated_batch = generator.denoise_batch(noisy_batch)
         generated_batch_cropped = crop_batch(generated_batch, crop_boundaries)
         # train discriminator based on its previous performance
-        discriminator_learns = (use_D and (discriminator.get_loss()+args.discriminator_advantage) > random.random()) or frozen_generator
+        if window_start:
+            discriminator_learns = (use_D and (discriminator.get_loss()+args.discriminator_advantage) > random.random()) or (use_D and frozen_generator)
+            discriminator2_learns = (use_D2 and (discriminator2.get_loss()+args.discriminator2_advantage) > random.random()) or (use_D2 and frozen_generator)
+            discriminator_learns, discriminator2_learns = rank0_decisions(discriminator_learns, discriminator2_learns)
+            if discriminator_workers:
+                generator_learns = decide_generator_learns(discriminator_learns, discriminator2_learns)
+        # discriminator workers compute the generator's losses before learning from this batch, so that they
+        # learn while the generator does
+        if discriminator_workers and generator_learns:
+            if use_D:
+                discriminator.request_generator_loss(generated_batch_cropped=generated_batch_cropped,
+                                                     noisy_batch_cropped=noisy_batch_cropped)
+            if use_D2:
+                discriminator2.request_generator_loss(generated_batch_cropped=generated_batch_cropped,
+                                                      noisy_batch_cropped=noisy_batch_cropped)
         if discriminator_learns:
             discriminator.learn(noisy_batch_cropped=noisy_batch_cropped,
                                 generated_batch_cropped=generated_batch_cropped,
-                                clean_batch_cropped=clean_batch_cropped)
-            loss_D_list.append(discriminator.get_loss())
+                                clean_batch_cropped=clean_batch_cropped, step=window_end)
+            # a worker's losses are collected at the end of the window
+            if not discriminator_workers:
+                window_losses['D'].append(discriminator.get_loss(on_device=True))
             iteration_summary += 'loss D: %f (%s)' % (discriminator.get_loss(), discriminator.get_predictions_range())
         # train discriminator2 based on its previous performance
-        discriminator2_learns = (use_D2 and (discriminator2.get_loss()+args.discriminator2_advantage) > random.random()) or (use_D2 and frozen_generator)
         if discriminator2_learns:
             discriminator2.learn(noisy_batch_cropped=noisy_batch_cropped,
                                 generated_batch_cropped=generated_batch_cropped,
-                                clean_batch_cropped=clean_batch_cropped)
-            loss_D2_list.append(discriminator2.get_loss())
+                                clean_batch_cropped=clean_batch_cropped, step=window_end)
+            if not discriminator_workers:
+                window_losses['D2'].append(discriminator2.get_loss(on_device=True))
             if discriminator_learns:
                 iteration_summary += ', '
             while len(iteration_summary) < 90:
                 iteration_summary += ' '
             iteration_summary += 'loss D2: %f (%s)' % (discriminator2.get_loss(), discriminator2.get_predictions_range())
         # train generator if discriminator didn't learn or discriminator is somewhat useful
-        generator_learns = not frozen_generator and (
-            (not discriminator_learns and not discriminator2_learns)
-            or (discriminator_learns and discriminator2_learns and (discriminator2.get_loss()+args.discriminator2_advantage+discriminator.get_loss()+args.discriminator_advantage)/2 < random.random())
-            or (discriminator_learns and (not discriminator2_learns) and discriminator.get_loss()+args.discriminator_advantage < random.random())
-            or (discriminator2_learns and (not discriminator_learns) and discriminator2.get_loss()+args.discriminator2_advantage < random.random())
-            )
+        if window_start and not discriminator_workers:
+            generator_learns = decide_generator_learns(discriminator_learns, discriminator2_learns)
         if generator_learns:
             if discriminator_learns or discriminator2_learns:
                 iteration_summary += ', '
@@ -184,58 +503,119 @@ for epoch in range(args.start_epoch, args.epochs):
             pregenres_space = 160 if use_D2 else pregenres_space
             while len(iteration_summary) < pregenres_space:
                 iteration_summary += ' '
-            if use_D:
+            discriminator_loss = discriminator2_loss = None
+            if use_D and discriminator_workers:
+                discriminator_loss = discriminator.get_generator_loss(generated_batch_cropped)
+            elif use_D:
                 discriminator_predictions = discriminator.discriminate_batch(
                     generated_batch_cropped=generated_batch_cropped,
                     noisy_batch_cropped=noisy_batch_cropped)
-            if use_D2:
+            if use_D2 and discriminator_workers:
+                discriminator2_loss = discriminator2.get_generator_loss(generated_batch_cropped)
+            elif use_D2:
                 discriminator2_predictions = discriminator2.discriminate_batch(
                     generated_batch_cropped=generated_batch_cropped,
                     noisy_batch_cropped=noisy_batch_cropped)
-            else:
-                discriminator2_predictions = None
             generator.learn(generated_batch_cropped=generated_batch_cropped,
                             clean_batch_cropped=clean_batch_cropped,
                             discriminator_predictions=discriminator_predictions,
-                            discriminator2_predictions=discriminator2_predictions)
-            loss_G_list.append(generator.get_loss()['weighted'])
-            loss_G_SSIM_list.append(generator.get_loss()['SSIM'])
+                            discriminator2_predictions=discriminator2_predictions, step=window_end,
+                            discriminator_loss=discriminator_loss, discriminator2_loss=discriminator2_loss)
+            if args.hard_example_sampling:
+                hard_example_sampler.record(batch_indices, generator.get_per_sample_loss())
+            window_losses['G'].append(generator.get_loss(on_device=True)['weighted'])
+            if 'SSIM' in generator.get_loss(on_device=True):
+                window_losses['G_SSIM'].append(generator.get_loss(on_device=True)['SSIM'])
             iteration_summary += 'loss G: %s' % generator.get_loss(pretty_printed=True)
         else:
+            # discriminators keep the fake batch (with the generator's graph) for discriminate_batch
+            if use_D:
+                discriminator.release_fake_batch()
+            if use_D2:
+                discriminator2.release_fake_batch()
+        if not generator_learns and window_end:
             generator.zero_grad()
             if frozen_generator:
-                frozen_generator = discriminator.get_loss() > 0.33 and ((not use_D2) or discriminator2.get_loss() > 0.33)
-        p.print(iteration_summary)
+                frozen_generator = ((not use_D) or discriminator.get_loss() > 0.33) and ((not use_D2) or discriminator2.get_loss() > 0.33)
+                frozen_generator, = rank0_decisions(frozen_generator)
+        if window_end:
+            # one loss per optimizer step (averaged over its batches)
+            if discriminator_workers and use_D:
+                window_losses['D'] = discriminator.collect_losses()
+            if discriminator_workers and use_D2:
+                window_losses['D2'] = discriminator2.collect_losses()
+            step_losses = {}
+            for losses, window_key in ((loss_D_list, 'D'), (loss_D2_list, 'D2'), (loss_G_list, 'G'), (loss_G_SSIM_list, 'G_SSIM')):
+                if len(window_losses[window_key]) > 0:
+                    step_losses['loss_'+window_key] = average_losses(window_losses[window_key])
+                    losses.append(step_losses['loss_'+window_key])
+            if generator_learns:
+                step_losses.update({'loss_G_'+key: value for key, value in generator.get_loss(on_device=True).items() if key not in ('weighted', 'SSIM')})
+            step = (iteration-1)//args.accumulation_steps+1
+            # console summaries show the last losses read back from the device
+            metrics.log('step', console_line=iteration_summary if step % args.loss_sync_interval == 0 else None, epoch=epoch,
+                        step=step, g_lr=generator_learning_rate,
+                        d_lr=discriminator_learning_rate if use_D else None, step_time=time.time()-step_start_time,
+                        **step_losses)
 
     p.print("Epoch %u summary:" % epoch)
     p.print("Time elapsed (s): %u (epoch), %u (total)" % (time.time()-epoch_start_time,
                                                           time.time()-start_time))
+    epoch_metrics = {'epoch_time': time.time()-epoch_start_time}
+    if DDataset.crop_cache is not None:
+        p.print(DDataset.crop_cache.get_stats(reset=True))
+    if args.batched_augmentation:
+        p.print(augmenter.get_transfer_stats(reset=True))
+    if args.hard_example_sampling:
+        p.print(hard_example_sampler.get_stats())
     p.print("Generator:")
     if len(loss_G_SSIM_list) > 0:
-        p.print("Average SSIM loss: %f" % statistics.mean(loss_G_SSIM_list))
+        epoch_metrics['loss_G_SSIM'] = average_over_ranks(average_losses(loss_G_SSIM_list).item())
+        p.print("Average SSIM loss: %f" % epoch_metrics['loss_G_SSIM'])
     if len(loss_G_list) > 0:
-        average_g_weighted_loss = statistics.mean(loss_G_list)
+        average_g_weighted_loss = average_over_ranks(average_losses(loss_G_list).item())
         p.print("Average weighted loss: %f" % average_g_weighted_loss)
+        epoch_metrics['loss_G'] = average_g_weighted_loss
         generator_learning_rate = generator.update_learning_rate(average_g_weighted_loss)
     else:
         p.print("Generator learned nothing")
     if use_D:
         p.print("Discriminator:")
         if len(loss_D_list) > 0:
-            average_d_loss = statistics.mean(loss_D_list)
+            average_d_loss = average_over_ranks(average_losses(loss_D_list).item())
             p.print("Average normalized loss: %f" % (average_d_loss))
+            epoch_metrics['loss_D'] = average_d_loss
             discriminator_learning_rate = discriminator.update_learning_rate(average_d_loss)
-            discriminator.save_model(model_dir, epoch, 'discriminator')
+            if rank == 0:
+                discriminator.save_model(model_dir, epoch, 'discriminator', writer=checkpoint_writer)
     if use_D2:
         p.print("Discriminator2:")
         if len(loss_D2_list) > 0:
-            average_d2_loss = statistics.mean(loss_D2_list)
+            average_d2_loss = average_over_ranks(average_losses(loss_D2_list).item())
             p.print("Average normalized loss: %f" % (average_d2_loss))
+            epoch_metrics['loss_D2'] = average_d2_loss
             discriminator2_learning_rate = discriminator2.update_learning_rate(average_d2_loss)
-            discriminator2.save_model(model_dir, epoch, 'discriminator2')
-    if not frozen_generator:
-        generator.save_model(model_dir, epoch, 'generator')
-    if args.time_limit < time.time() - start_time:
+            if rank == 0:
+                discriminator2.save_model(model_dir, epoch, 'discriminator2', writer=checkpoint_writer)
+    metrics.log('epoch', epoch=epoch, g_lr=generator_learning_rate, d_lr=discriminator_learning_rate if use_D else None,
+                **epoch_metrics)
+    metrics.flush()
+    if not frozen_generator and rank == 0:
+        generator.save_model(model_dir, epoch, 'generator', writer=checkpoint_writer)
+    if rank == 0:
+        checkpoint_writer.save({
+            'epoch': epoch,
+            'frozen_generator': frozen_generator,
+            'warmup_done': warmup_done,
+            'generator': generator.get_training_state(),
+            'discriminator': discriminator.get_training_state() if use_D else None,
+            'discriminator2': discriminator2.get_training_state() if use_D2 else None,
+            'hard_example_losses': hard_example_sampler.losses if args.hard_example_sampling else None,
+            'rng': {'random': random.getstate(), 'torch': torch.get_rng_state(),
+                    'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}},
+            training_state_path)
+    time_is_up, = rank0_decisions(args.time_limit < time.time() - start_time)
+    if time_is_up:
         p.print("Time is up")
         exit(0)
     if (discriminator_learning_rate < args.min_lr or not use_D) and generator_learning_rate < args.min_lr:
@@ -0,0 +1,158 @@
+# train several generator configurations (eg a sweep of funit, loss weights or learning rates) on the same
+# batches: every batch is loaded and augmented once and fed to all of them. Each generator has its own
+# optimizer, learning rate scheduler, checkpoints (models/<expname>/<config>) and logs.
+# configurations are comma-separated overrides of this script's generator options, eg:
+# python3 nn_train_multi.py --g_network UNet --weight_SSIM 1 --batch_size 30 --train_data datasets/train/NIND_128_96 --configs g_funit=32 g_funit=48 g_funit=64,g_lr=0.0001
+import argparse
+import os
+import sys
+import time
+import datetime
+import atexit
+import torch
+from torch.utils.data import DataLoader
+import torch.backends.cudnn as cudnn
+from dataset_torch_3 import DenoisingDataset
+from augmentation import BatchAugmenter
+from prefetch_loader import DevicePrefetcher
+from checkpoint_writer import CheckpointWriter
+from nn_common import default_values, Generator, Printer, MetricsLogger, get_crop_boundaries, get_weights
+from train_options import add_training_arguments, add_generator_arguments
+
+parser = argparse.ArgumentParser(description='Shared-batch trainer for several mthesis-denoise generators')
+parser.add_argument('--configs', nargs='+', required=True, help='(space-separated) Generator configurations, each a comma-separated list of option=value overrides (eg g_funit=48,g_lr=0.0001)')
+add_training_arguments(parser)
+# options which a configuration may override
+config_options = add_generator_arguments(parser)
+
+args = parser.parse_args()
+
+if args.batch_size == 'auto':
+    print('Error: --batch_size auto is not supported by nn_train_multi.py')
+    exit(1)
+
+if args.test_reserve is None or args.test_reserve == []:
+    test_reserve = default_values['test_reserve']
+else:
+    test_reserve = args.test_reserve
+if args.train_data is None or args.train_data == []:
+    train_data = default_values['train_data']
+else:
+    train_data = args.train_data
+if args.cuda_device >= 0 and torch.cuda.is_available():
+    torch.cuda.set_device(args.cuda_device)
+    device = torch.device("cuda:"+str(args.cuda_device))
+else:
+    device = torch.device('cpu')
+if args.uint8_transport:
+    args.batched_augmentation = True
+
+def crop_batch(batch, boundaries):
+    return batch[:, :, boundaries[0]:boundaries[1], boundaries[0]:boundaries[1]]
+
+cudnn.benchmark = True
+
+torch.manual_seed(123)
+torch.cuda.manual_seed(123)
+
+expname = (datetime.datetime.now().isoformat()[:-10]+'_'+'_'.join(sys.argv).replace('/','-'))[0:255]
+p = Printer(file_path=os.path.join('results', 'train', expname))
+p.print(args)
+p.print("cmd: python3 "+" ".join(sys.argv))
+checkpoint_writer = CheckpointWriter(printer=p)
+atexit.register(checkpoint_writer.close)
+
+DDataset = DenoisingDataset(train_data, test_reserve=test_reserve, cache_bytes=args.crop_cache_mb*1048576,
+                            batched_augmentation=args.batched_augmentation, return_uint8=args.uint8_transport)
+data_loader = DataLoader(dataset=DDataset, num_workers=args.threads, drop_last=True, batch_size=args.batch_size,
+                         shuffle=True, pin_memory=args.uint8_transport and device.type == 'cuda')
+if args.batched_augmentation:
+    augmenter = BatchAugmenter(device)
+
+def load_batch(batch):
+    if args.batched_augmentation:
+        return augmenter(batch[0], batch[1], batch[2])
+    return batch[0].to(device, non_blocking=True), batch[1].to(device, non_blocking=True)
+
+batches = DevicePrefetcher(data_loader, device, prefetch=args.prefetch, transform=load_batch)
+
+# one generator (with its own optimizer, scheduler, checkpoints and logs) per configuration
+class Run:
+    def __init__(self, config):
+        overrides = [(option.split('=', 1)+[''])[:2] for option in config.split(',')]
+        for key, _ in overrides:
+            if key not in config_options:
+                p.print('Error: %s cannot be set per configuration (available: %s)' % (key, ', '.join(config_options)))
+                exit(1)
+        # later options override earlier ones
+        self.args = parser.parse_args(sys.argv[1:]+['--%s=%s' % (key, value) if value != '' else '--'+key for key, value in overrides])
+        self.name = config.replace(',', '_').replace('=', '-').replace('/', '-')
+        self.model_dir = os.path.join('models', expname, self.name)
+        os.makedirs(self.model_dir, exist_ok=True)
+        self.printer = Printer(tostdout=not args.quiet, file_path=os.path.join('results', 'train', expname+'_'+self.name))
+        # per-step summaries go through the run's printer
+        self.metrics = MetricsLogger(file_path=os.path.join('results', 'train', expname+'_'+self.name+'.jsonl'),
+                                     flush_every=args.metrics_flush_every,
+                                     console=None if args.quiet else self.printer.print)
+        atexit.register(self.metrics.flush)
+        self.printer.print(self.args)
+        # same weights as nn_train.py with these options, which must not leave any weight to a discriminator
+        weights = get_weights(argparse.Namespace(weight_D1=None, weight_D2=None, **vars(self.args)))
+        if weights['D1'] > 0 or weights['D2'] > 0:
+            p.print('Error: %s: the loss weights %s need a discriminator, which nn_train_multi.py does not train (--weight_SSIM and --weight_L1 must add up to 1)' % (config, weights))
+            exit(1)
+        self.generator = Generator(network=self.args.g_network, model_path=self.args.g_model_path, device=device,
+                                   weights=weights, activation=self.args.g_activation, funit=self.args.g_funit,
+                                   beta1=self.args.beta1, lr=self.args.g_lr, printer=self.printer,
+                                   compute_SSIM_anyway=self.args.compute_SSIM_anyway, patience=self.args.patience,
+                                   precision=self.args.precision)
+        self.crop_boundaries = get_crop_boundaries(DDataset.cs, DDataset.ucs, network=self.args.g_network)
+        self.learning_rate = self.args.g_lr
+        self.losses = []
+        self.done = False
+
+runs = [Run(config) for config in args.configs]
+
+start_time = time.time()
+for epoch in range(args.start_epoch, args.epochs):
+    epoch_start_time = time.time()
+    for iteration, (clean_batch, noisy_batch) in enumerate(batches, 1):
+        for run in runs:
+            if run.done:
+                continue
+            step_start_time = time.time()
+            generated_batch = run.generator.denoise_batch(noisy_batch)
+            run.generator.learn(generated_batch_cropped=crop_batch(generated_batch, run.crop_boundaries),
+                                clean_batch_cropped=crop_batch(clean_batch, run.crop_boundaries))
+            run.losses.append(run.generator.get_loss(on_device=True)['weighted'])
+            run.metrics.log('step', console_line='[%s] Epoch %u batch %u/%u: loss G: %s' % (
+                                run.name, epoch, iteration, len(data_loader), run.generator.get_loss(pretty_printed=True)),
+                            epoch=epoch, step=iteration, g_lr=run.learning_rate, step_time=time.time()-step_start_time,
+                            **{'loss_G_'+key: value for key, value in run.generator.get_loss(on_device=True).items()})
+    p.print("Epoch %u summary:" % epoch)
+    p.print("Time elapsed (s): %u (epoch), %u (total)" % (time.time()-epoch_start_time, time.time()-start_time))
+    if DDataset.crop_cache is not None:
+        p.print(DDataset.crop_cache.get_stats(reset=True))
+    for run in runs:
+        if run.done:
+            continue
+        if len(run.losses) == 0:
+            p.print("%s: generator learned nothing" % run.name)
+            continue
+        average_loss = torch.stack([loss.reshape(()) for loss in run.losses]).mean().item()
+        run.losses = []
+        p.print("%s: average weighted loss: %f" % (run.name, average_loss))
+        run.printer.print("Epoch %u average weighted loss: %f" % (epoch, average_loss))
+        run.learning_rate = run.generator.update_learning_rate(average_loss)
+        run.metrics.log('epoch', epoch=epoch, g_lr=run.learning_rate, loss_G=average_loss)
+        run.metrics.flush()
+        run.generator.save_model(run.model_dir, epoch, 'generator', writer=checkpoint_writer)
+        if run.learning_rate < args.min_lr:
+            p.print("%s: minimum learning rate reached" % run.name)
+            run.done = True
+    if args.time_limit < time.time() - start_time:
+        p.print("Time is up")
+        exit(0)
+    if all(run.done for run in runs):
+        p.print("Minimum learning rate reached")
+        exit(0)
@@ -16,6 +16,7 @@ import random
 from lib import pytorch_ssim
 from train_utils import get_crop_boundaries, gen_target_probabilities
 
+from prefetch_loader import DevicePrefetcher
 from networks.p2p_networks import define_G, define_D, get_scheduler, update_learning_rate
 
 # TODO refactor
@@ -42,6 +43,7 @@ parser.add_argument('--lr_policy', type=str, default='plateau', help='learning r
 parser.add_argument('--lr_decay_iters', type=int, default=50, help='multiply by a gamma every lr_decay_iters iterations')
 parser.add_argument('--beta1', type=float, default=0.5, help='beta1 for adam. default=0.5')
 parser.add_argument('--threads', type=int, default=8, help='number of threads for data loader to use')
+parser.add_argument('--prefetch', type=int, default=0, help='Number of batches loaded onto the training device in the background (default: 0, load each batch when it is needed)')
 parser.add_argument('--seed', type=int, default=123, help='random seed to use. Default=123')
 
 parser.add_argument('--weight_ssim_0', type=float, default=0.4, help='weight on SSIM term in objective')
@@ -172,6 +174,7 @@ res_dir = os.path.join(args.result_dir, expname)
 print('===> Loading datasets')
 DDataset = DenoisingDataset(train_data, compressionmin=args.compressionmin, compressionmax=args.compressionmax, sigmamin=args.sigmamin, sigmamax=args.sigmamax, test_reserve=args.test_reserve, yval=args.yval, do_sizecheck=args.do_sizecheck, exact_reserve=args.exact_reserve)
 training_data_loader = DataLoader(dataset=DDataset, num_workers=args.threads, drop_last=True, batch_size=args.batch_size, shuffle=True)
+training_batches = DevicePrefetcher(training_data_loader, device, prefetch=args.prefetch)
 #testing_data_loader = DataLoader(dataset=test_set, num_workers=args.threads, batch_size=args.test_batch_size, shuffle=False)
 
 
@@ -261,8 +264,7 @@ for epoch in range(args.epoch_count, args.niter + args.niter_decay + 1):
     num_train_g_std = 0
     loss_d_item = 1
     loss_d_item_str = 'nan'
-    for iteration, batch in enumerate(training_data_loader, 1):
-        cleanimg, noisyimg = batch[0].to(device), batch[1].to(device)
+    for iteration, (cleanimg, noisyimg) in enumerate(training_batches, 1):
         # generate clean image ("fake")
         optimizer_g.zero_grad()
         gnoisyimg = net_g(noisyimg)
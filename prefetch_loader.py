@@ -0,0 +1,83 @@
+# Wraps a DataLoader and stages its next batches on the training device from a background thread, so that
+# loading and host to device transfers overlap with the training step.
+# transform is applied to each collated batch in that thread and is responsible for moving it to the
+# device (default: move every tensor). On CUDA it runs on a separate stream from (pinned) host memory.
+# With prefetch=0 batches are transformed synchronously (same behavior as iterating over the loader).
+import queue
+import threading
+import torch
+
+class DevicePrefetcher:
+    def __init__(self, loader, device, prefetch=2, transform=None):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.prefetch = prefetch
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.loader)
+
+    def to_device(self, batch):
+        if self.transform is not None:
+            return self.transform(batch)
+        return [item.to(self.device, non_blocking=True) if isinstance(item, torch.Tensor) else item for item in batch]
+
+    @staticmethod
+    def pin(batch):
+        return [item.pin_memory() if isinstance(item, torch.Tensor) and not item.is_pinned() else item for item in batch]
+
+    @staticmethod
+    def tensors(batch):
+        return [item for item in batch if isinstance(item, torch.Tensor)]
+
+    def load(self, batches, stop):
+        use_cuda = self.device.type == 'cuda'
+        stream = torch.cuda.Stream(device=self.device) if use_cuda else None
+        try:
+            for batch in self.loader:
+                if stop.is_set():
+                    break
+                if use_cuda:
+                    with torch.cuda.stream(stream):
+                        batch = self.to_device(self.pin(batch))
+                        ready = torch.cuda.Event()
+                        ready.record(stream)
+                else:
+                    batch = self.to_device(batch)
+                    ready = None
+                batches.put((batch, ready))
+        except Exception as e:
+            batches.put((e, None))
+        batches.put(None)
+
+    def __iter__(self):
+        if self.prefetch <= 0:
+            for batch in self.loader:
+                yield self.to_device(batch)
+            return
+        batches = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        loader_thread = threading.Thread(target=self.load, args=(batches, stop), daemon=True)
+        loader_thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is None:
+                    break
+                batch, ready = item
+                if isinstance(batch, Exception):
+                    raise batch
+                if ready is not None:
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(ready)
+                    # memory allocated on the loader stream must not be reused before the training step is done
+                    for tensor in self.tensors(batch):
+                        tensor.record_stream(current_stream)
+                yield batch
+        finally:
+            stop.set()
+            while loader_thread.is_alive():
+                try:
+                    batches.get(timeout=0.1)
+                except queue.Empty:
+                    pass
@@ -9,10 +9,12 @@ import time
 import numpy as np
 import torch
 import networks.nnModules as nnModules
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, WeightedRandomSampler
 import torch.optim as optim
 from torch.optim.lr_scheduler import MultiStepLR, LambdaLR, StepLR
-from dataset_torch_3 import DenoisingDataset
+from dataset_torch_3 import DenoisingDataset, collate_iso_groups
+from augmentation import BatchAugmenter
+from prefetch_loader import DevicePrefetcher
 from lib import pytorch_ssim
 from random import randint
 from torchvision import models
@@ -40,7 +42,7 @@ parser.add_argument('--cuda_device', default=0, type=int, help='Device number (d
 parser.add_argument('--n_channels', default=128, type=int, help='Number of channels (default: 128)')
 parser.add_argument('--find_noise', action='store_true', help='(DnCNN) Model noise if set, otherwise generate clean image')
 parser.add_argument('--kernel_size', default=5, type=int, help='Kernel size')
-parser.add_argument('--compressionmin', type=str, default=100, help='Minimum compression level ([1,100], default=100)')
+parser.add_argument('--compressionmin', type=int, default=100, help='Minimum compression level ([1,100], default=100)')
 parser.add_argument('--compressionmax', type=int, default=100, help='Maximum compression level ([1,100], default=100)')
 parser.add_argument('--sigmamin', type=int, default=0, help='Minimum sigma (noise) value ([0,100], default=0)')
 parser.add_argument('--sigmamax', type=int, default=0, help='Maximum sigma (noise) value ([0,100], default=0)')
@@ -52,10 +54,24 @@ parser.add_argument('--lossf', default='SSIM', help='Loss function (SSIM or MSE)
 parser.add_argument('--test_reserve', nargs='*', help='Space separated list of image sets to be reserved for testing')
 parser.add_argument('--relu', default='relu', help='ReLU function (relu, rrelu)')
 parser.add_argument('--do_sizecheck', action='store_true', help='Skip crop size check for faster initial loading (rely on filename only)')
+parser.add_argument('--crop_cache_mb', type=int, default=0, help='Keep up to this many MB of decoded crops in shared memory (/dev/shm) for all data loader threads (default: 0, disabled)')
+parser.add_argument('--batched_augmentation', action='store_true', help='Rotate, flip, compress, and add noise to whole batches after collation instead of individual crops in the data loader threads')
+parser.add_argument('--uint8_transport', action='store_true', help='Send crops as uint8 from the data loader threads to the training device and convert them to float there (implies --batched_augmentation)')
+parser.add_argument('--augmentation_threads', type=int, default=4, help='Number of threads used for JPEG compression with --batched_augmentation (default: 4)')
+parser.add_argument('--compression_cache_mb', type=int, default=0, help='Keep up to this many MB of compressed crops in RAM with --batched_augmentation (default: 0, disabled)')
+parser.add_argument('--quality_bucket', type=int, default=1, help='Round compression levels to steps of this size, more crops are reused from the compression cache with larger steps (default: 1)')
+parser.add_argument('--prefetch', type=int, default=0, help='Number of batches loaded onto the training device in the background (default: 0, load each batch when it is needed)')
+parser.add_argument('--iso_group_size', type=int, default=1, help='Number of noisy crops paired with each loaded clean crop (batch_size must be a multiple of it, default: 1)')
+parser.add_argument('--min_crop_variance', type=float, default=0, help='Skip crops whose clean variance is lower (requires crop_stats.py output)')
+parser.add_argument('--min_crop_edge_energy', type=float, default=0, help='Skip crops whose clean edge energy is lower (requires crop_stats.py output)')
+parser.add_argument('--weight_crops_by', type=str, help='Sample crops proportionally to a crop statistic (mean, variance, edge_energy, noise) instead of uniformly (requires crop_stats.py output)')
+parser.add_argument('--crop_weight_power', type=float, default=1, help='Power applied to the --weight_crops_by statistic (default: 1)')
 parser.add_argument('--load_g_path', help='Load a pretrained model (ignores resume/expname options)')
 parser.add_argument('--load_g_state_dict_path', help='Load state dictionary into model')
 
 args = parser.parse_args()
+if args.uint8_transport:
+    args.batched_augmentation = True
 print(args)
 
 # memory eg:
@@ -178,8 +194,25 @@ if __name__ == '__main__':
         print("Warning: running on CPU is not sane")
     # Dataset
     #TODO replace num_workers
-    DDataset = DenoisingDataset(train_data, compressionmin=args.compressionmin, compressionmax=args.compressionmax, sigmamin=args.sigmamin, sigmamax=args.sigmamax, test_reserve=args.test_reserve, yval=args.yval, do_sizecheck=args.do_sizecheck)
-    DLoader = DataLoader(dataset=DDataset, num_workers=4, drop_last=True, batch_size=batch_size, shuffle=True)
+    DDataset = DenoisingDataset(train_data, compressionmin=args.compressionmin, compressionmax=args.compressionmax, sigmamin=args.sigmamin, sigmamax=args.sigmamax, test_reserve=args.test_reserve, yval=args.yval, do_sizecheck=args.do_sizecheck, cache_bytes=args.crop_cache_mb*1048576, batched_augmentation=args.batched_augmentation, return_uint8=args.uint8_transport, iso_group_size=args.iso_group_size, crop_stats=args.weight_crops_by is not None, min_crop_variance=args.min_crop_variance, min_crop_edge_energy=args.min_crop_edge_energy)
+    assert batch_size % args.iso_group_size == 0
+    if args.weight_crops_by is not None:
+        sampler = WeightedRandomSampler(DDataset.get_crop_weights(args.weight_crops_by, args.crop_weight_power), len(DDataset))
+    else:
+        sampler = None
+    DLoader = DataLoader(dataset=DDataset, num_workers=4, drop_last=True, batch_size=batch_size//args.iso_group_size, shuffle=sampler is None, sampler=sampler, pin_memory=args.uint8_transport and cuda, collate_fn=collate_iso_groups if args.iso_group_size > 1 else None)
+    if args.batched_augmentation:
+        augmenter = BatchAugmenter(device, compressionmin=args.compressionmin, compressionmax=args.compressionmax,
+                                   sigmamin=args.sigmamin, sigmamax=args.sigmamax, threads=args.augmentation_threads,
+                                   compression_cache_bytes=args.compression_cache_mb*1048576,
+                                   quality_bucket=args.quality_bucket)
+    def load_batch(batch_xy):
+        if args.batched_augmentation:
+            return augmenter(batch_xy[0], batch_xy[1], batch_xy[2])
+        elif cuda:
+            return batch_xy[0].cuda(non_blocking=True), batch_xy[1].cuda(non_blocking=True)
+        return batch_xy[0], batch_xy[1]
+    batches = DevicePrefetcher(DLoader, device, prefetch=args.prefetch, transform=load_batch)
     if args.model == 'UNet':
         loss_crop_lb = int((DDataset.cs-DDataset.ucs)/2)
         loss_crop_up = loss_crop_lb+DDataset.ucs
@@ -209,12 +242,8 @@ if __name__ == '__main__':
     for epoch in range(initial_epoch, args.epoch):
         epoch_loss = 0
         epoch_time = time.time()
-        for n_count, batch_xy in enumerate(DLoader):
+        for n_count, (batch_x, batch_y) in enumerate(batches):
             optimizer.zero_grad()
-            if cuda:
-                batch_x, batch_y = batch_xy[0].cuda(), batch_xy[1].cuda()
-            else:
-                batch_x, batch_y = batch_xy[0], batch_xy[1]
 
             loss = criterion(model(batch_y)[:,:,loss_crop_lb:loss_crop_up, loss_crop_lb:loss_crop_up], batch_x[:,:,loss_crop_lb:loss_crop_up, loss_crop_lb:loss_crop_up]).cuda()
             if args.lossf == 'SSIM':
@@ -225,7 +254,7 @@ if __name__ == '__main__':
             loss_ten += loss_item
             optimizer.step()
             if n_count % 10 == 0:
-                print('%4d %4d / %4d loss = %2.4f' % (epoch+1, n_count, len(DDataset)//batch_size, loss_ten/10))
+                print('%4d %4d / %4d loss = %2.4f' % (epoch+1, n_count, len(DLoader), loss_ten/10))
                 loss_ten = 0
         if args.scheduler == 'plateau':
             scheduler.step(epoch_loss/n_count)
@@ -235,6 +264,10 @@ if __name__ == '__main__':
         os.makedirs(save_dir, exist_ok=True)
         os.makedirs(res_dir, exist_ok=True)
         log('epoch = %4d , loss = %4.4f , time = %4.2f s' % (epoch+1, epoch_loss/n_count, elapsed_time))
+        if DDataset.crop_cache is not None:
+            log(DDataset.crop_cache.get_stats(reset=True))
+        if args.batched_augmentation:
+            log(augmenter.get_transfer_stats(reset=True))
         np.savetxt(res_dir+'/train_result_'+str(epoch)+'.txt', np.hstack((epoch+1, epoch_loss/n_count, elapsed_time)), fmt='%2.4f')
         # torch.save(model.state_dict(), os.path.join(save_dir, 'model_%03d.pth' % (epoch+1)))
         torch.save(model, os.path.join(save_dir, 'model_%03d.pth' % (epoch+1)))
@@ -0,0 +1,37 @@
+# command-line options shared by the training scripts (nn_train.py, nn_train_multi.py)
+from nn_common import default_values
+from batch_size_finder import batch_size_type
+
+# data loading, training length and logging options
+def add_training_arguments(parser):
+    parser.add_argument('--batch_size', type=batch_size_type, default=18, help="Training batch size, 'auto' (nn_train.py) for the largest one whose training step fits in --memory_fraction of the device's memory (probed once per networks, crop size and device, cached in models/batch_sizes.json)")
+    parser.add_argument('--time_limit', type=int, default=172800, help='Time limit (ends training)')
+    parser.add_argument('--test_reserve', nargs='*', help='Space separated list of image sets to be reserved for testing')
+    parser.add_argument('--train_data', nargs='*', help="(space-separated) Path(s) to the pre-cropped training data (default: %s)"%(" ".join(default_values['train_data'])))
+    parser.add_argument('--cuda_device', default=0, type=int, help='Device number (default: 0, typically 0-3, -1 for CPU)')
+    parser.add_argument('--threads', type=int, default=6, help='Number of threads for data loader to use')
+    parser.add_argument('--min_lr', type=float, default=0.00000005, help='Minimum learning rate (ends training)')
+    parser.add_argument('--epochs', type=int, default=9001, help='Number of epochs (ends training)')
+    parser.add_argument('--start_epoch', default=1, type=int, help='Starting epoch (cosmetics)')
+    parser.add_argument('--crop_cache_mb', type=int, default=0, help='Keep up to this many MB of decoded crops in shared memory (/dev/shm) for all data loader threads (default: 0, disabled)')
+    parser.add_argument('--batched_augmentation', action='store_true', help='Rotate and flip whole batches on the training device instead of individual crops in the data loader threads')
+    parser.add_argument('--uint8_transport', action='store_true', help='Send crops as uint8 from the data loader threads to the training device and convert them to float there (implies --batched_augmentation)')
+    parser.add_argument('--prefetch', type=int, default=0, help='Number of batches loaded onto the training device in the background (default: 0, load each batch when it is needed)')
+    parser.add_argument('--metrics_flush_every', type=int, default=100, help='Number of per-step metrics records buffered before they are appended to results/train/<expname>.jsonl (default: 100)')
+    parser.add_argument('--quiet', action='store_true', help='Do not print the per-step summary on the console')
+
+# generator options, returns their names (the options a nn_train_multi.py configuration may override)
+def add_generator_arguments(parser):
+    parser.add_argument('--g_network', type=str, default=default_values['g_network'], help='Generator network (default: %s)'%default_values['g_network'])
+    parser.add_argument('--g_activation', type=str, default='PReLU', help='Final activation function for generator')
+    parser.add_argument('--g_funit', type=int, default=32, help='Filter unit size for generator')
+    parser.add_argument('--g_model_path', help='Generator pretrained model path (.pth for model, .pt for dictionary)')
+    parser.add_argument('--g_lr', type=float, default=default_values['lr'], help='Initial learning rate for adam (generator)')
+    parser.add_argument('--beta1', type=float, default=default_values['beta1'], help='beta1 for adam. default=%f'%default_values['beta1'])
+    parser.add_argument('--weight_SSIM', type=float, help='Weight on SSIM term in objective')
+    parser.add_argument('--weight_L1', type=float, help='Weight on L1 term in objective')
+    parser.add_argument('--compute_SSIM_anyway', action='store_true', help='Compute and display SSIM loss even if not used')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'fp16', 'bf16'], help='Forward passes precision, fp16/bf16 use autocast (mixed precision) with fp32 losses and gradient scaling (default: fp32, CPU: bf16 only)')
+    parser.add_argument('--patience', type=int, default=default_values['patience'], help='Number of epochs without improvements before scheduler updates learning rate')
+    return ['g_network', 'g_activation', 'g_funit', 'g_model_path', 'g_lr', 'beta1', 'weight_SSIM', 'weight_L1',
+            'compute_SSIM_anyway', 'precision', 'patience']